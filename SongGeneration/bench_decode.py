@@ -0,0 +1,128 @@
+"""
+Benchmark of the diffusion decoding settings against the 50-step Euler reference, on LM tokens
+saved by `generate.py --token_store` (no prompt audio):
+
+    python3 bench_decode.py ckpt_path token_store --num_songs 4
+    python3 bench_decode.py ckpt_path token_store --configs euler:50,euler:20,heun:10,dpm_multistep:20,rk23:10
+    python3 bench_decode.py ckpt_path token_store --configs euler:50:interval=0.0-0.8,euler:50:reuse=1
+
+Every config `solver:num_steps[:option=value...]` decodes the same songs from the same noise (same
+seed), and is reported with its wall-clock time, number of estimator evaluations (NFE, a guided
+evaluation counts once even on the doubled batch) and distance to the reference audio: waveform SNR
+and log-mel L1. Comparing configs of similar time tells which settings give the most faithful audio
+for a given budget. Options are `interval=t_min-t_max` (guidance interval), `reuse=k` (reuse of the
+unconditional estimate) and the solver parameters, e.g. `rtol=0.02` for rk23.
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+import torchaudio
+from omegaconf import OmegaConf
+
+from generate import register_resolvers
+from codeclm.models import builders
+from codeclm.utils.token_store import TokenStore
+
+
+REFERENCE = 'euler:50'
+
+
+def parse_config(config):
+    """Decode parameters of `solver:num_steps[:option=value...]`."""
+    solver, num_steps, *options = config.split(':')
+    params = {'solver': solver, 'num_steps': int(num_steps)}
+    for option in options:
+        name, value = option.split('=')
+        if name == 'interval':
+            params['guidance_interval'] = tuple(float(t) for t in value.split('-'))
+        elif name == 'reuse':
+            params['uncond_reuse'] = int(value)
+        else:
+            params[name] = float(value)
+    return params
+
+
+class NFECounter:
+    """Count the forward passes of a module."""
+    def __init__(self, module):
+        self.count = 0
+        module.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        self.count += 1
+
+
+def decode(tokenizer, tokens, params, seed):
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        wav = tokenizer.decode([tokens[:, [1], :], tokens[:, [2], :]], **params)
+    return wav[0].float().cpu()
+
+
+def snr(reference, estimate):
+    length = min(reference.shape[-1], estimate.shape[-1])
+    reference, estimate = reference[..., :length], estimate[..., :length]
+    noise = (reference - estimate).pow(2).sum()
+    return (10 * torch.log10(reference.pow(2).sum() / noise.clamp_min(1e-12))).item()
+
+
+def mel_l1(mel, reference, estimate):
+    length = min(reference.shape[-1], estimate.shape[-1])
+    log_mel = lambda wav: torch.log(mel(wav[..., :length]).clamp_min(1e-5))
+    return (log_mel(reference) - log_mel(estimate)).abs().mean().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ckpt_path')
+    parser.add_argument('token_store', help="token store filled by generate.py --token_store")
+    parser.add_argument('--num_songs', type=int, default=4)
+    parser.add_argument('--configs', default='euler:20,midpoint:10,heun:10,dpm_multistep:10,dpm_multistep:20,rk23:10',
+                        help=f"comma separated solver:num_steps[:option=value...], compared to {REFERENCE}")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.backends.cudnn.enabled = False
+    register_resolvers()
+    cfg = OmegaConf.load(os.path.join(args.ckpt_path, 'config.yaml'))
+    cfg.mode = 'inference'
+    tokenizer = builders.get_audio_tokenizer_model(cfg.audio_tokenizer_checkpoint_sep, cfg)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    tokenizer = tokenizer.eval().to(device)
+    counter = NFECounter(tokenizer.model.model.cfm_wrapper.estimator)
+    mel = torchaudio.transforms.MelSpectrogram(sample_rate=cfg.sample_rate, n_fft=2048, hop_length=512, n_mels=128)
+
+    store = TokenStore(args.token_store)
+    songs = [store.get(key) for key in list(store.index)[:args.num_songs]]
+    songs = [tokens for tokens in songs if tokens is not None]
+    assert songs, f"no tokens in {args.token_store}"
+
+    configs = [REFERENCE] + [config for config in args.configs.split(',') if config != REFERENCE]
+    results = {config: {'time': [], 'nfe': [], 'snr': [], 'mel_l1': []} for config in configs}
+    for i, tokens in enumerate(songs):
+        reference = None
+        for config in configs:
+            params = parse_config(config)
+            counter.count = 0
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start_time = time.time()
+            wav = decode(tokenizer, tokens, params, args.seed + i)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            results[config]['time'].append(time.time() - start_time)
+            results[config]['nfe'].append(counter.count)
+            if reference is None:
+                reference = wav
+            results[config]['snr'].append(snr(reference, wav))
+            results[config]['mel_l1'].append(mel_l1(mel, reference, wav))
+
+    print(f"{len(songs)} songs, reference {REFERENCE}")
+    print(f"{'config':<32}{'time (s)':>10}{'NFE':>8}{'SNR (dB)':>10}{'log-mel L1':>12}")
+    for config in configs:
+        result = {name: float(np.mean(values)) for name, values in results[config].items()}
+        snr_text = 'ref' if config == REFERENCE else f"{result['snr']:.2f}"
+        print(f"{config:<32}{result['time']:>10.2f}{result['nfe']:>8.0f}{snr_text:>10}{result['mel_l1']:>12.4f}")
@@ -0,0 +1,68 @@
+"""
+CPU check that the sdpa attention of the LM (`LlamaSdpaAttention`) matches the eager one (`LlamaAttention`)
+on random weights, for every kind of step of the generation:
+
+    python3 check_sdpa.py
+
+- prefill: the whole sequence at once, causal mode of the kernel;
+- decode: a single query after the cached prefix, no mask;
+- cached prefix: several queries after a cached prefix, the [q, kv] mask of the sdpa path;
+- fallback: `output_attentions=True`, where the sdpa module runs the eager path without a mask from LmModel.
+
+The eager module is given the causal mask LmModel builds for it, the sdpa module none.
+"""
+import sys
+
+import torch
+
+from codeclm.models.llama.modeling_llama import (LlamaConfig, LlamaAttention, LlamaSdpaAttention,
+                                                 _make_causal_mask)
+
+
+def attend(attention, hidden_states, past_key_value=None, attention_mask=None, output_attentions=False):
+    past = 0 if past_key_value is None else past_key_value[0].shape[-2]
+    bsz, q_len, _ = hidden_states.shape
+    position_ids = torch.arange(past, past + q_len).unsqueeze(0).expand(bsz, q_len)
+    return attention(hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+                     past_key_value=past_key_value, output_attentions=output_attentions, use_cache=True)
+
+
+def eager_mask(hidden_states, past):
+    bsz, q_len, _ = hidden_states.shape
+    if q_len == 1:
+        return None
+    return _make_causal_mask((bsz, q_len), hidden_states.dtype, hidden_states.device, past_key_values_length=past)
+
+
+def check(name, eager, sdpa, hidden_states, past_key_value=None, output_attentions=False, atol=1e-5):
+    past = 0 if past_key_value is None else past_key_value[0].shape[-2]
+    expected, _, expected_cache = attend(eager, hidden_states, past_key_value, eager_mask(hidden_states, past))
+    output, _, cache = attend(sdpa, hidden_states, past_key_value, output_attentions=output_attentions)
+    error = max((expected - output).abs().max().item(),
+                (expected_cache[0] - cache[0]).abs().max().item(),
+                (expected_cache[1] - cache[1]).abs().max().item())
+    print(f"{name:<16} max abs error {error:.2e}")
+    return error <= atol, expected_cache
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    config = LlamaConfig(hidden_size=64, num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128)
+    eager = LlamaAttention(config).eval()
+    sdpa = LlamaSdpaAttention(config).eval()
+    sdpa.load_state_dict(eager.state_dict())
+
+    batch_size, prefix, step = 2, 12, 5
+    ok = True
+    with torch.no_grad():
+        passed, cache = check("prefill", eager, sdpa, torch.randn(batch_size, prefix, config.hidden_size))
+        ok &= passed
+        passed, _ = check("decode", eager, sdpa, torch.randn(batch_size, 1, config.hidden_size), cache)
+        ok &= passed
+        passed, _ = check("cached prefix", eager, sdpa, torch.randn(batch_size, step, config.hidden_size), cache)
+        ok &= passed
+        passed, _ = check("fallback", eager, sdpa, torch.randn(batch_size, step, config.hidden_size), cache,
+                          output_attentions=True)
+        ok &= passed
+    print("ok" if ok else "MISMATCH")
+    sys.exit(0 if ok else 1)
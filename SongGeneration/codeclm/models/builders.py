@@ -36,8 +36,14 @@ def get_audio_tokenizer_model(checkpoint_path: str, cfg: omegaconf.DictConfig):
         name = checkpoint_path
         return AudioTokenizer.get_pretrained(name, cfg.vae_config, cfg.vae_model, 'cpu', mode=cfg.mode)
     
-def get_lm_model(cfg: omegaconf.DictConfig): #-> LMModel:
-    """Instantiate a LM."""    
+def get_lm_model(cfg: omegaconf.DictConfig, device: tp.Union[str, torch.device] = 'cpu'): #-> LMModel:
+    """Instantiate a LM on `device`. On the 'meta' device nothing is allocated nor initialized,
+    the weights are then given by `load_lm_weights`."""
+    with torch.device(device):
+        return _get_lm_model(cfg)
+
+
+def _get_lm_model(cfg: omegaconf.DictConfig): #-> LMModel:
     lm_kwargs = dict_from_config(getattr(cfg, 'lm'))
     
     # n_q: number of RVQ
@@ -76,11 +82,36 @@ def get_lm_model(cfg: omegaconf.DictConfig): #-> LMModel:
             attribute_dropout=attribute_dropout,
             cfg=cfg,
             **lm_kwargs
-        ).to('cpu')
+        )
     else:
         raise KeyError(f"Unexpected LM model {lm_type}")
 
 
+def load_lm_weights(lm: torch.nn.Module, state_dict: tp.Dict[str, torch.Tensor],
+                    device: tp.Union[str, torch.device], dtype: tp.Optional[torch.dtype] = None):
+    """Load `state_dict` into a LM built on the meta device, using its tensors as parameters
+    (no copy, so they should already be on `device` and in `dtype`). Parameters missing from
+    `state_dict` get their default init and the non-persistent buffers are recomputed on `device`.
+    Returns the missing and unexpected keys.
+    """
+    from .llama.modeling_llama import LlamaRotaryEmbedding
+    missing, unexpected = lm.load_state_dict(state_dict, strict=False, assign=True)
+    for name, module in lm.named_modules():
+        params = list(module.parameters(recurse=False))
+        if params and all(p.is_meta for p in params):
+            module.to_empty(device=device, recurse=False)
+            if hasattr(module, 'reset_parameters'):
+                module.reset_parameters()
+        elif any(p.is_meta for p in params):
+            raise RuntimeError(f"{name} is only partially covered by the checkpoint")
+        if isinstance(module, LlamaRotaryEmbedding):
+            module.reset_buffers(device)
+    still_meta = [name for name, t in list(lm.named_parameters()) + list(lm.named_buffers()) if t.is_meta]
+    assert not still_meta, f"tensors left on the meta device: {still_meta}"
+    lm.to(device=device, dtype=dtype)
+    return missing, unexpected
+
+
 def get_conditioner_provider(output_dim: int, cfg: omegaconf.DictConfig) -> ConditionerProvider:
     """Instantiate a conditioning model."""    
     cfg = getattr(cfg, 'conditioners')
@@ -51,8 +51,9 @@ class CodecLM:
         assert max_duration is not None
 
         self.max_duration: float = max_duration
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         self.generation_params: dict = {}
+        self.decode_params: dict = {}
         # self.set_generation_params(duration=15)  # 15 seconds by default
         self.set_generation_params(duration=15, extend_stride=self.max_duration // 2)
         self._progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None
@@ -95,6 +96,24 @@ class CodecLM:
             'record_window': record_window,
         }
 
+    def set_decode_params(self, num_steps: int = 50, solver: str = 'euler',
+                          guidance_interval: tp.Optional[tp.Tuple[float, float]] = None, uncond_reuse: int = 0,
+                          **solver_kwargs):
+        """Set the diffusion parameters of `generate_audio` with the separate tokenizer.
+
+        Args:
+            num_steps (int, optional): Number of ODE steps of every window. Defaults to 50.
+            solver (str, optional): ODE solver, one of euler, midpoint, heun, dpm_multistep, rk23.
+                Defaults to 'euler'.
+            guidance_interval (tuple of float, optional): Interval of t where classifier free guidance is
+                applied, the conditional estimate alone is used elsewhere. Defaults to the whole trajectory.
+            uncond_reuse (int, optional): Number of guided evaluations reusing the last unconditional
+                estimate before it is computed again. Defaults to 0.
+            **solver_kwargs: Extra parameters of the solver, e.g. `rtol` and `atol` of rk23.
+        """
+        self.decode_params = {'num_steps': num_steps, 'solver': solver, 'guidance_interval': guidance_interval,
+                              'uncond_reuse': uncond_reuse, **solver_kwargs}
+
     def set_custom_progress_callback(self, progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None):
         """Override the default progress callback."""
         self._progress_callback = progress_callback
@@ -106,18 +125,67 @@ class CodecLM:
                  melody_is_wav: bool = True,
                  vocal_wavs: torch.Tensor = None,
                  bgm_wavs: torch.Tensor = None,
+                 audio_qt_embs: torch.Tensor = None,
                  return_tokens: bool = False,
-                 ) -> tp.Union[torch.Tensor, tp.Tuple[torch.Tensor, torch.Tensor]]:
+                 num_variations: int = 1,
+                 generators: tp.Optional[tp.List[torch.Generator]] = None,
+                 ) -> tp.Union[torch.Tensor, tp.List[torch.Tensor]]:
         """Generate samples conditioned on text and melody.
 
         Args:
+            lyrics (list of str): A list of lyrics, one per generated song.
             descriptions (list of str): A list of strings used as text conditioning.
             melody_wavs: (torch.Tensor or list of Tensor): A batch of waveforms used as
                 melody conditioning. Should have shape [B, C, T] with B matching the description length,
                 C=1 or 2. It can be [C, T] if there is a single description. It can also be
                 a list of [C, T] tensors.
-            melody_sample_rate: (int): Sample rate of the melody waveforms.
-            progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            melody_is_wav (bool): Whether the melody/vocal/bgm inputs are waveforms or already tokens.
+            audio_qt_embs (torch.Tensor, optional): Prompt tokens of shape [B, 3, T] as returned by
+                `prepare_prompt_tokens`, used instead of the melody/vocal/bgm inputs. This allows to batch
+                songs whose prompts are of different kinds.
+            return_tokens (bool): Return the generated tokens instead of the decoded audio.
+            num_variations (int): Number of takes of every song, sampled from a single prefill of its conditions.
+            generators (list of torch.Generator, optional): One RNG per song, so that the tokens of a song
+                only depend on its own generator and not on the songs batched with it. The global RNG if None.
+        Returns:
+            A tensor of shape [1, K, T] when a single song is generated, else a list of such tensors,
+            each one trimmed at its own EOS. The takes of a song are consecutive in the list.
+        """
+        if audio_qt_embs is None:
+            audio_qt_embs = self.prepare_prompt_tokens(melody_wavs=melody_wavs, vocal_wavs=vocal_wavs, 
+                                                       bgm_wavs=bgm_wavs, melody_is_wav=melody_is_wav)
+        assert audio_qt_embs.shape[0] == len(lyrics), \
+            f"number of prompts must match number of lyrics! " \
+            f"got prompts len={audio_qt_embs.shape[0]}, and lyrics len={len(lyrics)}"
+        texts = [lyric for lyric in lyrics]
+        if generators is not None:
+            assert len(generators) == len(lyrics), f"{len(generators)} generators for {len(lyrics)} songs"
+        tokens = self._generate_tokens(texts, descriptions, audio_qt_embs, num_variations=num_variations,
+                                       generators=generators)
+
+        # trim every song at its own EOS
+        tokens = [self._trim_eos(tokens[[b]]) for b in range(tokens.shape[0])]
+
+        if return_tokens:
+            out = tokens
+        else:
+            out = [self.generate_audio(t) for t in tokens]
+        return out[0] if len(out) == 1 else out
+
+    def _trim_eos(self, tokens: torch.Tensor) -> torch.Tensor:
+        if (tokens == self.lm.eos_token_id).any():
+            length = torch.nonzero(torch.eq(tokens, self.lm.eos_token_id))[:,-1].min()
+            tokens = tokens[...,:length] 
+        return tokens
+
+    @torch.no_grad()
+    def prepare_prompt_tokens(self,
+                              melody_wavs: torch.Tensor = None,
+                              vocal_wavs: torch.Tensor = None,
+                              bgm_wavs: torch.Tensor = None,
+                              melody_is_wav: bool = True) -> torch.Tensor:
+        """Turn the melody/vocal/bgm prompts into the [B, 3, T] prompt tokens used by the LM.
+        Missing prompts are filled with the empty prompt token.
         """
         if melody_wavs is not None:
             if melody_wavs.dim() == 2:
@@ -138,19 +206,30 @@ class CodecLM:
                 raise ValueError("BGM wavs should have a shape [B, C, T].")
             bgm_wavs = list(bgm_wavs)
         
-        texts, audio_qt_embs = self._prepare_tokens_and_attributes(lyrics=lyrics, melody_wavs=melody_wavs, vocal_wavs=vocal_wavs, bgm_wavs=bgm_wavs, melody_is_wav=melody_is_wav)
-        tokens = self._generate_tokens(texts, descriptions, audio_qt_embs)
+        batch_size = 1
+        for wavs in [melody_wavs, vocal_wavs, bgm_wavs]:
+            if wavs is not None:
+                batch_size = len(wavs)
+        _, audio_qt_embs = self._prepare_tokens_and_attributes(lyrics=[None] * batch_size, melody_wavs=melody_wavs, vocal_wavs=vocal_wavs, bgm_wavs=bgm_wavs, melody_is_wav=melody_is_wav)
+        return audio_qt_embs
 
-        if (tokens == self.lm.eos_token_id).any():
-            length = torch.nonzero(torch.eq(tokens, self.lm.eos_token_id))[:,-1].min()
-            tokens = tokens[...,:length] 
-
-        if return_tokens:
-            return tokens
-        else:
-            out = self.generate_audio(tokens)
-            return out
 
+    @torch.no_grad()
+    def encode_prompt_audio(self, melody_wavs: torch.Tensor, vocal_wavs: torch.Tensor, 
+                            bgm_wavs: torch.Tensor) -> tp.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Encode the [B, C, T] (or [C, T]) waveforms of a prompt into their unpadded 1rvq (melody)
+        and septoken (vocal, bgm) codes. The codes can be given back to `prepare_prompt_tokens`
+        with `melody_is_wav=False`.
+        """
+        if melody_wavs.dim() == 2:
+            melody_wavs = melody_wavs[None]
+        if vocal_wavs.dim() == 2:
+            vocal_wavs = vocal_wavs[None]
+        if bgm_wavs.dim() == 2:
+            bgm_wavs = bgm_wavs[None]
+        melody_tokens, scale = self.audiotokenizer.encode(melody_wavs.to(self.device))
+        vocal_tokens, bgm_tokens = self.seperate_tokenizer.encode(vocal_wavs.to(self.device), bgm_wavs.to(self.device))
+        return melody_tokens, vocal_tokens, bgm_tokens
 
     @torch.no_grad()
     def _prepare_tokens_and_attributes(
@@ -169,13 +248,13 @@ class CodecLM:
             melody_wavs (torch.Tensor, optional): A batch of waveforms
                 used as melody conditioning. Defaults to None.
         """
-        assert len(lyrics) == 1
         texts = [lyric for lyric in lyrics]
+        B = len(texts)
         audio_qt_embs = []
         target_melody_token_len = self.lm.cfg.prompt_len * self.frame_rate
         # import pdb; pdb.set_trace()
         if melody_wavs is None:
-            melody_tokens = torch.full((1,1,target_melody_token_len), 16385, device=self.device).long()
+            melody_tokens = torch.full((B,1,target_melody_token_len), 16385, device=self.device).long()
         elif melody_wavs is not None:
             if 'prompt_audio' not in self.lm.condition_provider.conditioners:
                 raise RuntimeError("This model doesn't support melody conditioning. "
@@ -193,12 +272,12 @@ class CodecLM:
             if melody_tokens.shape[-1] > target_melody_token_len:
                 melody_tokens = melody_tokens[...,:target_melody_token_len]
             elif melody_tokens.shape[-1] < target_melody_token_len:
-                melody_tokens = torch.cat([melody_tokens, torch.full((1,1,target_melody_token_len - melody_tokens.shape[-1]), 16385, device=self.device).long()], dim=-1)
+                melody_tokens = torch.cat([melody_tokens, torch.full((B,1,target_melody_token_len - melody_tokens.shape[-1]), 16385, device=self.device).long()], dim=-1)
 
         if bgm_wavs is None:
             assert vocal_wavs is None, "vocal_wavs is not None when bgm_wavs is None"
-            bgm_tokens = torch.full((1,1,target_melody_token_len), 16385, device=self.device).long()
-            vocal_tokens = torch.full((1,1,target_melody_token_len), 16385, device=self.device).long()
+            bgm_tokens = torch.full((B,1,target_melody_token_len), 16385, device=self.device).long()
+            vocal_tokens = torch.full((B,1,target_melody_token_len), 16385, device=self.device).long()
         else:
             assert vocal_wavs is not None, "vocal_wavs is None when bgm_wavs is not None"
             if type(vocal_wavs) == list:
@@ -221,11 +300,11 @@ class CodecLM:
             if bgm_tokens.shape[-1] > target_melody_token_len:
                 bgm_tokens = bgm_tokens[...,:target_melody_token_len]
             elif bgm_tokens.shape[-1] < target_melody_token_len:
-                bgm_tokens = torch.cat([bgm_tokens, torch.full((1,1,target_melody_token_len - bgm_tokens.shape[-1]), 16385, device=self.device).long()], dim=-1)
+                bgm_tokens = torch.cat([bgm_tokens, torch.full((B,1,target_melody_token_len - bgm_tokens.shape[-1]), 16385, device=self.device).long()], dim=-1)
             if vocal_tokens.shape[-1] > target_melody_token_len:
                 vocal_tokens = vocal_tokens[...,:target_melody_token_len]
             elif vocal_tokens.shape[-1] < target_melody_token_len:
-                vocal_tokens = torch.cat([vocal_tokens, torch.full((1,1,target_melody_token_len - vocal_tokens.shape[-1]), 16385, device=self.device).long()], dim=-1)
+                vocal_tokens = torch.cat([vocal_tokens, torch.full((B,1,target_melody_token_len - vocal_tokens.shape[-1]), 16385, device=self.device).long()], dim=-1)
         melody_tokens = torch.cat([melody_tokens, vocal_tokens, bgm_tokens], dim=1)
         assert melody_tokens.shape[-1] == target_melody_token_len
         audio_qt_embs = melody_tokens.long()
@@ -236,7 +315,9 @@ class CodecLM:
     def _generate_tokens(self, 
                         texts: tp.Optional[tp.List[str]] = None,
                         descriptions: tp.Optional[tp.List[str]] = None,
-                        audio_qt_embs: tp.Optional[tp.List[torch.Tensor]] = None) -> torch.Tensor:
+                        audio_qt_embs: tp.Optional[tp.List[torch.Tensor]] = None,
+                        num_variations: int = 1,
+                        generators: tp.Optional[tp.List[torch.Generator]] = None) -> torch.Tensor:
         """Generate discrete audio tokens given audio prompt and/or conditions.
 
         Args:
@@ -265,11 +346,59 @@ class CodecLM:
                                               descriptions=descriptions, 
                                               audio_qt_embs=audio_qt_embs, 
                                               max_gen_len=total_gen_len, 
+                                              num_variations=num_variations,
+                                              generator=generators,
                                               **self.generation_params)
         else:
-            raise NotImplementedError(f"duration {self.duration} < max duration {self.max_duration}")
+            gen_tokens = torch.cat(list(self.stream_tokens(texts, descriptions, audio_qt_embs, 
+                                                           num_variations=num_variations, 
+                                                           generators=generators)), dim=-1)
         return gen_tokens
 
+    @torch.no_grad()
+    def stream_tokens(self, 
+                      texts: tp.Optional[tp.List[str]] = None,
+                      descriptions: tp.Optional[tp.List[str]] = None,
+                      audio_qt_embs: tp.Optional[torch.Tensor] = None,
+                      num_variations: int = 1,
+                      generators: tp.Optional[tp.List[torch.Generator]] = None) -> tp.Iterator[torch.Tensor]:
+        """Generate `self.duration` seconds of tokens window by window, yielding the new tokens
+        [B, K, t] of every window as soon as it is sampled.
+
+        The first window covers `max_duration`. Every following window keeps the last
+        `max_duration - extend_stride` seconds as prompt and samples `extend_stride` new seconds,
+        so the attention span, and the memory, never exceed one window whatever the duration.
+        The key/value states of the kept tokens cannot be reused, as their positions change from
+        one window to the next: the prompt is prefilled again, in one step, at the start of the window.
+        Generation stops early once every sequence has emitted EOS.
+        """
+        total_gen_len = int(self.duration * self.frame_rate)
+        stride_tokens = int(self.frame_rate * self.extend_stride)
+        assert stride_tokens > 0, "extend_stride must be positive for generation beyond max_duration"
+        prompt_tokens = None
+        current_gen_offset = 0
+        while current_gen_offset < total_gen_len:
+            prompt_length = 0 if prompt_tokens is None else prompt_tokens.shape[-1]
+            chunk_len = min(total_gen_len - current_gen_offset + prompt_length, 
+                            int(self.max_duration * self.frame_rate))
+            with self.autocast:
+                gen_tokens = self.lm.generate(texts=texts, 
+                                              descriptions=descriptions, 
+                                              audio_qt_embs=audio_qt_embs, 
+                                              prompt=prompt_tokens,
+                                              max_gen_len=chunk_len, 
+                                              num_variations=num_variations,
+                                              generator=generators,
+                                              **self.generation_params)
+            new_tokens = gen_tokens[..., prompt_length:]
+            yield new_tokens
+            current_gen_offset += new_tokens.shape[-1]
+            if self._progress_callback is not None:
+                self._progress_callback(min(current_gen_offset, total_gen_len), total_gen_len)
+            if (new_tokens == self.lm.eos_token_id).any(dim=-1).any(dim=-1).all():
+                break
+            prompt_tokens = gen_tokens[..., stride_tokens:]
+
     @torch.no_grad()
     def generate_audio(self, gen_tokens: torch.Tensor, prompt=None, vocal_prompt=None, bgm_prompt=None, chunked=False):
         """Generate Audio from tokens"""
@@ -279,8 +408,20 @@ class CodecLM:
             gen_tokens_vocal = gen_tokens[:, [1], :]
             gen_tokens_bgm = gen_tokens[:, [2], :]
             # gen_audio_song = self.audiotokenizer.decode(gen_tokens_song, prompt)
-            gen_audio_seperate = self.seperate_tokenizer.decode([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked)
+            gen_audio_seperate = self.seperate_tokenizer.decode([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked,
+                                                                **self.decode_params)
             return gen_audio_seperate
         else:
             gen_audio = self.audiotokenizer.decode(gen_tokens, prompt)
             return gen_audio
+
+    @torch.no_grad()
+    def generate_audio_batch(self, gen_tokens_list: tp.List[torch.Tensor], vocal_prompts=None, bgm_prompts=None,
+                             chunked=False) -> tp.List[torch.Tensor]:
+        """Generate the audio of several songs from their tokens with the separate tokenizer, the diffusion
+        windows of the songs being decoded as one batch."""
+        assert self.seperate_tokenizer is not None, "batched decoding needs the separate tokenizer"
+        assert all(gen_tokens.dim() == 3 for gen_tokens in gen_tokens_list)
+        codes_list = [[gen_tokens[:, [1], :], gen_tokens[:, [2], :]] for gen_tokens in gen_tokens_list]
+        return self.seperate_tokenizer.decode_batch(codes_list, vocal_prompts, bgm_prompts, chunked=chunked,
+                                                    **self.decode_params)
@@ -1,7 +1,9 @@
 
-from .llama.modeling_llama import LlamaConfig, CausalLMOutputWithPast, BaseModelOutputWithPast, LlamaDecoderLayer, LlamaRMSNorm
+from .llama.modeling_llama import LlamaConfig, CausalLMOutputWithPast, BaseModelOutputWithPast, LlamaDecoderLayer, LlamaRMSNorm, LlamaAttention
+from .llama.modeling_llama import _make_causal_mask
 from .llama.modeling_llama import LlamaForCausalLM as LlamaForCausalLM_base
 from .llama.modeling_llama import LlamaModel as LlamaModel_base
+from .llama.cache_utils import StaticKVCache, past_length
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -32,8 +34,10 @@ class CausalLM(LlamaForCausalLM_base):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        num_logits_to_keep: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
-
+        """`num_logits_to_keep` only projects the last positions on the vocabulary (all of them if None),
+        when generating only the last one is sampled. `hidden_states` always covers every position."""
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -54,12 +58,13 @@ class CausalLM(LlamaForCausalLM_base):
         )
 
         hidden_states = outputs[0]
+        projected_states = hidden_states if num_logits_to_keep is None else hidden_states[:, -num_logits_to_keep:]
         if self.config.pretraining_tp > 1:
             lm_head_slices = self.lm_head.weight.split(self.vocab_size // self.config.pretraining_tp, dim=0)
-            logits = [F.linear(hidden_states, lm_head_slices[i]) for i in range(self.config.pretraining_tp)]
+            logits = [F.linear(projected_states, lm_head_slices[i]) for i in range(self.config.pretraining_tp)]
             logits = torch.cat(logits, dim=-1)
         else:
-            logits = self.lm_head(hidden_states)
+            logits = self.lm_head(projected_states)
         logits = logits.float()
 
         loss = None
@@ -90,6 +95,8 @@ class CausalLM(LlamaForCausalLM_base):
 
 """Submodel class"""
 class LmModel(LlamaModel_base):
+    MAX_CACHED_MASKS = 16
+
     def __init__(self, config: LlamaConfig):
         super().__init__(config)
         self.padding_idx = config.pad_token_id
@@ -102,10 +109,26 @@ class LmModel(LlamaModel_base):
         self.norm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
         self.gradient_checkpointing = False
+        # causal masks without padding, by (query length, past length, dtype, device)
+        self._causal_masks = {}
         # Initialize weights and apply final processing
         self.post_init()
         self.gradient_checkpointing_disable()
 
+    def _causal_mask(self, seq_length: int, past_key_values_length: int, dtype: torch.dtype,
+                     device: torch.device) -> torch.Tensor:
+        """Additive [1, 1, seq_length, past + seq_length] causal mask, built once per shape. Only
+        multi-token steps need one (prefill, prompts), so the cache stays small; it is bounded anyway
+        for training on varying lengths."""
+        key = (seq_length, past_key_values_length, dtype, device)
+        mask = self._causal_masks.get(key)
+        if mask is None:
+            if len(self._causal_masks) >= self.MAX_CACHED_MASKS:
+                self._causal_masks.clear()
+            mask = _make_causal_mask((1, seq_length), dtype, device, past_key_values_length)
+            self._causal_masks[key] = mask
+        return mask
+
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -140,7 +163,7 @@ class LmModel(LlamaModel_base):
         past_key_values_length = 0
 
         if past_key_values is not None:
-            past_key_values_length = past_key_values[0][0].shape[2]
+            past_key_values_length = past_length(past_key_values)
             seq_length_with_past = seq_length_with_past + past_key_values_length
 
         if position_ids is None:
@@ -153,13 +176,16 @@ class LmModel(LlamaModel_base):
             position_ids = position_ids.view(-1, seq_length).long()
 
         # embed positions
-        if attention_mask is None:
-            attention_mask = torch.ones(
-                (batch_size, seq_length_with_past), dtype=torch.bool, device=inputs_embeds.device
+        if attention_mask is not None:
+            attention_mask = self._prepare_decoder_attention_mask(
+                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
             )
-        attention_mask = self._prepare_decoder_attention_mask(
-            attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
-        )
+        elif seq_length > 1 and self.layers[0].self_attn.__class__ is LlamaAttention:
+            attention_mask = self._causal_mask(
+                seq_length, past_key_values_length, inputs_embeds.dtype, inputs_embeds.device
+            ).expand(batch_size, 1, seq_length, seq_length_with_past)
+        # otherwise there is no padding and nothing to mask: a single query attends to every position,
+        # flash attention and sdpa apply the causal mask themselves
 
         hidden_states = inputs_embeds
 
@@ -212,6 +238,10 @@ class LmModel(LlamaModel_base):
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
 
+        if isinstance(past_key_values, StaticKVCache):
+            # every layer wrote its states in place, the same cache is returned
+            past_key_values.advance(seq_length)
+            next_decoder_cache = past_key_values
         next_cache = next_decoder_cache if use_cache else None
         if not return_dict:
             return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
@@ -0,0 +1,93 @@
+from typing import Optional, Tuple
+
+import torch
+
+
+class StaticKVCache:
+    """Key/value cache of all the layers of a model, preallocated once and written in place.
+
+    The legacy cache is a tuple of `(key, value)` per layer that every decoding step concatenates
+    with the new states, copying the whole cache again and again. Here the buffers of a layer are
+    allocated on its first write, with room for that first (prefill) chunk plus `max_new_tokens`,
+    and later steps only write their own positions. Attention reads views of the filled part.
+
+    Indexing the cache gives the `StaticLayerCache` of a layer, so that it can be passed to the
+    decoder layers as `past_key_values` in place of the tuple of tuples.
+
+    Args:
+        num_layers (int): Number of decoder layers.
+        max_new_tokens (int): Number of positions which may be written after the first chunk.
+    """
+    def __init__(self, num_layers: int, max_new_tokens: int):
+        self.max_new_tokens = max_new_tokens
+        self.layers = [StaticLayerCache(self) for _ in range(num_layers)]
+        self.seq_len = 0
+
+    @classmethod
+    def from_legacy(cls, past_key_values, max_new_tokens: int) -> "StaticKVCache":
+        """Static cache starting with the `(key, value)` tuples of every layer, e.g. a prefix
+        computed ahead of time."""
+        cache = cls(len(past_key_values), max_new_tokens)
+        for layer, (key_states, value_states) in zip(cache.layers, past_key_values):
+            layer.update(key_states, value_states)
+        cache.advance(past_key_values[0][0].shape[2])
+        return cache
+
+    def __getitem__(self, idx: int) -> "StaticLayerCache":
+        return self.layers[idx]
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def get_seq_length(self) -> int:
+        """Number of positions already in the cache."""
+        return self.seq_len
+
+    def advance(self, num_tokens: int):
+        """Move past the `num_tokens` positions all the layers just wrote, called once per forward."""
+        self.seq_len += num_tokens
+
+
+class StaticLayerCache:
+    """Buffers of one layer of a `StaticKVCache`, of shape [B, num_heads, capacity, head_dim]."""
+    def __init__(self, parent: StaticKVCache):
+        self.parent = parent
+        self.key: Optional[torch.Tensor] = None
+        self.value: Optional[torch.Tensor] = None
+
+    def get_seq_length(self) -> int:
+        return self.parent.seq_len
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write the new states at the current offset and return the keys and values of all the
+        positions so far, as views of the buffers."""
+        start = self.parent.seq_len
+        end = start + key_states.shape[2]
+        if self.key is None:
+            bsz, num_heads, _, head_dim = key_states.shape
+            capacity = end + self.parent.max_new_tokens
+            self.key = key_states.new_empty((bsz, num_heads, capacity, head_dim))
+            self.value = value_states.new_empty((bsz, num_heads, capacity, value_states.shape[-1]))
+        if end > self.key.shape[2]:
+            raise ValueError(f"static cache of {self.key.shape[2]} positions is full, cannot write up to {end}")
+        self.key[:, :, start:end] = key_states
+        self.value[:, :, start:end] = value_states
+        return self.key[:, :, :end], self.value[:, :, :end]
+
+
+def past_length(past_key_values) -> int:
+    """Number of cached positions of `past_key_values`, a `StaticKVCache` or legacy tuples."""
+    if past_key_values is None:
+        return 0
+    if isinstance(past_key_values, StaticKVCache):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[2]
+
+
+def layer_past_length(past_key_value) -> int:
+    """Number of cached positions of one layer, a `StaticLayerCache` or a legacy (key, value) tuple."""
+    if past_key_value is None:
+        return 0
+    if isinstance(past_key_value, StaticLayerCache):
+        return past_key_value.get_seq_length()
+    return past_key_value[0].shape[-2]
@@ -89,6 +89,10 @@ class LlamaConfig(PretrainedConfig):
             experimental feature, subject to breaking API changes in future versions.
         attention_bias (`bool`, defaults to `False`):
             Whether to use a bias in the query, key, value and output projection layers during self-attention.
+        attention_implementation (`str`, *optional*, defaults to `"eager"`):
+            Attention used when flash attention 2 is not enabled: `"eager"` for the explicit matmul/softmax, or
+            `"sdpa"` for `torch.nn.functional.scaled_dot_product_attention`, which needs no materialized mask
+            for causal attention without padding.
 
         Example:
 
@@ -128,6 +132,7 @@ class LlamaConfig(PretrainedConfig):
         rope_theta=10000.0,
         rope_scaling=None,
         attention_bias=False,
+        attention_implementation="eager",
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -151,6 +156,9 @@ class LlamaConfig(PretrainedConfig):
         self.rope_scaling = rope_scaling
         self._rope_scaling_validation()
         self.attention_bias = attention_bias
+        if attention_implementation not in ("eager", "sdpa"):
+            raise ValueError(f"`attention_implementation` must be 'eager' or 'sdpa', got {attention_implementation}")
+        self.attention_implementation = attention_implementation
 
         super().__init__(
             pad_token_id=pad_token_id,
@@ -39,6 +39,7 @@ from transformers.utils import (
     replace_return_docstrings,
 )
 from .configuration_llama import LlamaConfig
+from .cache_utils import StaticLayerCache, layer_past_length
 
 
 if is_flash_attn_available():
@@ -141,6 +142,14 @@ class LlamaRotaryEmbedding(nn.Module):
         self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False)
         self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False)
 
+    def reset_buffers(self, device=None):
+        """Recompute the (non-persistent) buffers on `device`, e.g. when the module was built on the meta device."""
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim))
+        self.register_buffer("inv_freq", inv_freq, persistent=False)
+        self._set_cos_sin_cache(
+            seq_len=self.max_position_embeddings, device=self.inv_freq.device, dtype=torch.get_default_dtype()
+        )
+
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
         if seq_len > self.max_seq_len_cached:
@@ -215,6 +224,66 @@ def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
     return q_embed, k_embed
 
 
+def _split_fused_state_dict(module, state_dict, prefix, local_metadata):
+    # state dict hook: a fused linear is saved as the linears it replaced
+    for fused_name, (names, sizes) in module.fused_linears.items():
+        for suffix in ("weight", "bias"):
+            fused_key = f"{prefix}{fused_name}.{suffix}"
+            if fused_key in state_dict:
+                for name, tensor in zip(names, state_dict.pop(fused_key).split(sizes, dim=0)):
+                    state_dict[f"{prefix}{name}.{suffix}"] = tensor
+    return state_dict
+
+
+def _pack_fused_state_dict(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                           error_msgs):
+    # load state dict pre hook: the linears of a checkpoint are packed into the fused one
+    for fused_name, (names, sizes) in module.fused_linears.items():
+        for suffix in ("weight", "bias"):
+            keys = [f"{prefix}{name}.{suffix}" for name in names]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}{fused_name}.{suffix}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+
+@torch.no_grad()
+def fuse_linears(module: nn.Module, names: List[str], fused_name: str):
+    """
+    Replace the linears `names` of `module`, all applied to the same input, by a single linear `fused_name` whose
+    output is their outputs concatenated, so that one GEMM is launched instead of several. The weights are packed
+    once, and the state dict keeps the keys of the original linears, both when saving and loading.
+    """
+    linears = [getattr(module, name) for name in names]
+    weight = linears[0].weight
+    fused = nn.Linear(
+        linears[0].in_features, sum(linear.out_features for linear in linears),
+        bias=linears[0].bias is not None, device="meta",
+    )
+    fused.weight = nn.Parameter(torch.cat([linear.weight for linear in linears], dim=0),
+                                requires_grad=weight.requires_grad)
+    if fused.bias is not None:
+        fused.bias = nn.Parameter(torch.cat([linear.bias for linear in linears], dim=0),
+                                  requires_grad=weight.requires_grad)
+    for name in names:
+        delattr(module, name)
+    setattr(module, fused_name, fused)
+
+    if not hasattr(module, "fused_linears"):
+        module.fused_linears = {}
+        module._register_state_dict_hook(_split_fused_state_dict)
+        module._register_load_state_dict_pre_hook(_pack_fused_state_dict, with_module=True)
+    module.fused_linears[fused_name] = (names, [linear.out_features for linear in linears])
+
+
+def fuse_projections(model: nn.Module):
+    """
+    Inference-time weight packing: fuse the query/key/value projections of every attention layer of `model` and the
+    gate/up projections of every MLP. Modules using tensor-parallel slices (`pretraining_tp > 1`) are left as is.
+    """
+    for module in model.modules():
+        if isinstance(module, (LlamaAttention, LlamaMLP)) and module.config.pretraining_tp == 1:
+            module.fuse_projections()
+
+
 class LlamaMLP(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -225,6 +294,12 @@ class LlamaMLP(nn.Module):
         self.up_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
         self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=False)
         self.act_fn = ACT2FN[config.hidden_act]
+        self.gate_up_proj = None
+
+    def fuse_projections(self):
+        """Pack `gate_proj` and `up_proj` into `gate_up_proj`, see `fuse_linears`."""
+        if self.gate_up_proj is None:
+            fuse_linears(self, ["gate_proj", "up_proj"], "gate_up_proj")
 
     def forward(self, x):
         if self.config.pretraining_tp > 1:
@@ -243,6 +318,9 @@ class LlamaMLP(nn.Module):
                 F.linear(intermediate_states[i], down_proj_slices[i]) for i in range(self.config.pretraining_tp)
             ]
             down_proj = sum(down_proj)
+        elif self.gate_up_proj is not None:
+            gate_proj, up_proj = self.gate_up_proj(x).chunk(2, dim=-1)
+            down_proj = self.down_proj(self.act_fn(gate_proj) * up_proj)
         else:
             down_proj = self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
 
@@ -284,8 +362,20 @@ class LlamaAttention(nn.Module):
         self.k_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=config.attention_bias)
         self.v_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=config.attention_bias)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=config.attention_bias)
+        self.qkv_proj = None
         self._init_rope()
 
+    def fuse_projections(self):
+        """Pack `q_proj`, `k_proj` and `v_proj` into `qkv_proj`, see `fuse_linears`."""
+        if self.qkv_proj is None:
+            fuse_linears(self, ["q_proj", "k_proj", "v_proj"], "qkv_proj")
+
+    def _project_qkv(self, hidden_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if self.qkv_proj is not None:
+            kv_size = self.num_key_value_heads * self.head_dim
+            return self.qkv_proj(hidden_states).split([self.num_heads * self.head_dim, kv_size, kv_size], dim=-1)
+        return self.q_proj(hidden_states), self.k_proj(hidden_states), self.v_proj(hidden_states)
+
     def _init_rope(self):
         if self.config.rope_scaling is None:
             self.rotary_emb = LlamaRotaryEmbedding(
@@ -346,26 +436,25 @@ class LlamaAttention(nn.Module):
             value_states = torch.cat(value_states, dim=-1)
 
         else:
-            query_states = self.q_proj(hidden_states)
-            key_states = self.k_proj(hidden_states)
-            value_states = self.v_proj(hidden_states)
+            query_states, key_states, value_states = self._project_qkv(hidden_states)
 
         query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
+        kv_seq_len = key_states.shape[-2] + layer_past_length(past_key_value)
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
-
-        past_key_value = (key_states, value_states) if use_cache else None
+        if isinstance(past_key_value, StaticLayerCache):
+            # written in place, the cache object itself is handed back
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
+            past_key_value = (key_states, value_states) if use_cache else None
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -434,9 +523,7 @@ class LlamaFlashAttention2(LlamaAttention):
 
         bsz, q_len, _ = hidden_states.size()
 
-        query_states = self.q_proj(hidden_states)
-        key_states = self.k_proj(hidden_states)
-        value_states = self.v_proj(hidden_states)
+        query_states, key_states, value_states = self._project_qkv(hidden_states)
 
         # Flash attention requires the input to have the shape
         # batch_size x seq_length x head_dime x hidden_dim
@@ -445,20 +532,21 @@ class LlamaFlashAttention2(LlamaAttention):
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
+        kv_seq_len = key_states.shape[-2] + layer_past_length(past_key_value)
 
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
-
-        past_key_value = (key_states, value_states) if use_cache else None
+        if isinstance(past_key_value, StaticLayerCache):
+            # written in place, the cache object itself is handed back
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
+            past_key_value = (key_states, value_states) if use_cache else None
 
         query_states = query_states.transpose(1, 2)
         key_states = key_states.transpose(1, 2)
@@ -590,15 +678,109 @@ class LlamaFlashAttention2(LlamaAttention):
         )
 
 
+class LlamaSdpaAttention(LlamaAttention):
+    """
+    Llama attention module using `torch.nn.functional.scaled_dot_product_attention`. This module inherits from
+    `LlamaAttention` as the weights of the module stays untouched, only the attention itself is computed by the fused
+    (flash / memory efficient / math) kernels of torch instead of an explicit matmul and softmax.
+
+    With `attention_mask=None` the attention is causal without padding and no mask is materialized: the kernel's
+    causal mode is used when the queries start the sequence, single-query steps attend to everything, and queries
+    following a cached part only build a small [q_len, kv_seq_len] boolean mask.
+    """
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        output_attentions: bool = False,
+        use_cache: bool = False,
+        padding_mask: Optional[torch.LongTensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if output_attentions or self.config.pretraining_tp > 1:
+            # the fused kernel does not return the attention weights; the eager path needs the causal mask
+            # that LmModel leaves out for sdpa
+            q_len = hidden_states.shape[1]
+            if attention_mask is None and q_len > 1:
+                attention_mask = _make_causal_mask(
+                    (hidden_states.shape[0], q_len),
+                    hidden_states.dtype,
+                    hidden_states.device,
+                    past_key_values_length=layer_past_length(past_key_value),
+                )
+            return super().forward(
+                hidden_states,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_value=past_key_value,
+                output_attentions=output_attentions,
+                use_cache=use_cache,
+                padding_mask=padding_mask,
+            )
+
+        bsz, q_len, _ = hidden_states.size()
+
+        query_states, key_states, value_states = self._project_qkv(hidden_states)
+
+        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+        key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+        value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+
+        kv_seq_len = key_states.shape[-2] + layer_past_length(past_key_value)
+        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
+
+        if isinstance(past_key_value, StaticLayerCache):
+            # written in place, the cache object itself is handed back
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
+            past_key_value = (key_states, value_states) if use_cache else None
+
+        key_states = repeat_kv(key_states, self.num_key_value_groups)
+        value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+        is_causal = False
+        if attention_mask is not None:
+            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+                raise ValueError(
+                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+                )
+            attention_mask = attention_mask.to(query_states.dtype)
+        elif q_len == kv_seq_len:
+            is_causal = q_len > 1
+        elif q_len > 1:
+            # the causal mode of the kernel aligns the queries with the first keys, not the last ones
+            attention_mask = torch.ones(
+                (q_len, kv_seq_len), dtype=torch.bool, device=query_states.device
+            ).tril(diagonal=kv_seq_len - q_len)
+
+        attn_output = F.scaled_dot_product_attention(
+            query_states, key_states, value_states, attn_mask=attention_mask, is_causal=is_causal
+        )
+
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = self.o_proj(attn_output)
+
+        return attn_output, None, past_key_value
+
+
 class LlamaDecoderLayer(nn.Module):
     def __init__(self, config: LlamaConfig):
         super().__init__()
         self.hidden_size = config.hidden_size
-        self.self_attn = (
-            LlamaAttention(config=config)
-            if not getattr(config, "_flash_attn_2_enabled", False)
-            else LlamaFlashAttention2(config=config)
-        )
+        if getattr(config, "_flash_attn_2_enabled", False):
+            self.self_attn = LlamaFlashAttention2(config=config)
+        elif getattr(config, "attention_implementation", "eager") == "sdpa":
+            self.self_attn = LlamaSdpaAttention(config=config)
+        else:
+            self.self_attn = LlamaAttention(config=config)
         self.mlp = LlamaMLP(config)
         self.input_layernorm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
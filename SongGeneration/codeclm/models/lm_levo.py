@@ -8,6 +8,8 @@ import torch.nn.functional as F
 from tqdm import tqdm
 from dataclasses import dataclass
 from codeclm.models.levo import CausalLM, LlamaConfig
+from codeclm.models.llama.cache_utils import StaticKVCache
+from codeclm.models.llama.modeling_llama import fuse_projections
 from codeclm.modules.streaming import StreamingModule
 from codeclm.modules.conditioners import (
     ConditioningAttributes,
@@ -19,7 +21,8 @@ from codeclm.modules.conditioners import (
     ClassifierFreeGuidanceDropout,
     AttributeDropout,
 )
-from codeclm.utils.utils import create_norm_fn, init_layer, sample_top_k, sample_top_p, multinomial
+from codeclm.utils.utils import create_norm_fn, init_layer
+from codeclm.utils.sampling import RepetitionWindow, CodebookSampler
 from codeclm.modules.pattern import CodebooksPatternProvider
 ConditionTensors = tp.Dict[str, ConditionType]
 
@@ -54,6 +57,9 @@ class LmModel(StreamingModule):
         cfg_coef (float): Classifier-free guidance coefficient.
         attribute_dropout (dict): Attribute dropout probabilities.
         two_step_cfg (bool): Whether to run classifier free-guidance with 2 distinct steps.
+        use_flash_attn_2 (bool): Use flash attention 2 in the transformers.
+        attention_implementation (str): Attention of the transformers without flash attention 2,
+            'eager' or 'sdpa' (torch scaled_dot_product_attention).
         **kwargs: Additional parameters for the transformer encoder.
     """
     def __init__(self, 
@@ -77,6 +83,7 @@ class LmModel(StreamingModule):
                  num_layers_sub: int = 12,
                  cfg = None,
                  use_flash_attn_2: bool = True,
+                 attention_implementation: str = 'eager',
                  **kwargs):
         super().__init__()
 
@@ -106,6 +113,7 @@ class LmModel(StreamingModule):
             rms_norm_eps= 1e-5,
             rope_theta= rope_theta,
             _flash_attn_2_enabled=use_flash_attn_2,
+            attention_implementation=attention_implementation,
         )
 
         self.transformer = CausalLM(model_cfg)
@@ -128,6 +136,7 @@ class LmModel(StreamingModule):
             rms_norm_eps= 1e-5,
             rope_theta= rope_theta_sub,
             _flash_attn_2_enabled=use_flash_attn_2,
+            attention_implementation=attention_implementation,
         )
 
         self.transformer2 = CausalLM(sub_model_cfg)
@@ -142,6 +151,8 @@ class LmModel(StreamingModule):
         self._init_weights(weight_init, depthwise_init, zero_bias_init)
         self._fsdp: tp.Optional[nn.Module]
         self.__dict__['_fsdp'] = None
+        # key/value states of the null-condition prefix, computed once per (device, dtype), see `_null_prefix_kv`
+        self.__dict__['_null_prefix_cache'] = {}
 
         self.reset_streaming()
         
@@ -168,6 +179,12 @@ class LmModel(StreamingModule):
         for emb_layer in self.emb:
             init_layer(emb_layer, method=weight_init, init_depth=None, zero_bias_init=zero_bias_init)
 
+    def fuse_projections(self):
+        """Inference-time packing of the q/k/v and gate/up projections of both transformers into
+        single linears, one GEMM instead of three (two) per layer and step. The state dict keeps
+        the checkpoint keys. Call it once the weights are loaded."""
+        fuse_projections(self.transformer)
+        fuse_projections(self.transformer2)
     
     @property
     def special_token_id(self) -> int:
@@ -212,6 +229,7 @@ class LmModel(StreamingModule):
             tokenized = self.condition_provider.tokenize(attributes)
             condition_tensors = self.condition_provider(tokenized)
         else:
+            device = next(iter(self.parameters())).device
             conditions = []
             for i in range(batch_size):
                 attr = ConditioningAttributes()
@@ -225,7 +243,7 @@ class LmModel(StreamingModule):
                     mask = mask.repeat(1, 1, audio_qt_seq.shape[-1])
                     audio_qt_seq[mask] = 16385
                     attr["audio"]['prompt_audio'] = AudioCondition(
-                        wav=audio_qt_seq.long().cuda(), 
+                        wav=audio_qt_seq.long().to(device), 
                         length=torch.Tensor([audio_qt_seq.shape[-1]]).long(),
                         sample_rate=[self.cfg.sample_rate],)
                 if 'type_info' in self.condition_provider.conditioners:
@@ -243,9 +261,87 @@ class LmModel(StreamingModule):
             condition_tensors = self.condition_provider(tokenized_conditions)
         return condition_tensors
         
+    @torch.no_grad()
+    def _null_condition_tensors(self) -> ConditionTensors:
+        """Condition tensors of a single sample whose conditions are all dropped, the
+        unconditional half of classifier-free guidance."""
+        device = next(iter(self.parameters())).device
+        cfg_inference = ClassifierFreeGuidanceDropoutInference()
+        attr = ConditioningAttributes()
+        if 'description' in self.condition_provider.conditioners:
+            attr["text"]["description"] = None
+        if 'prompt_audio' in self.condition_provider.conditioners:
+            depth = self.condition_provider.conditioners['prompt_audio'].code_depth
+            attr["audio"]['prompt_audio'] = cfg_inference.get_null_wav(
+                torch.zeros((1, depth, 1), dtype=torch.long, device=device), sr=self.cfg.sample_rate)
+        if 'type_info' in self.condition_provider.conditioners:
+            attr["text"]["type_info"] = None
+        return self.condition_provider(self.condition_provider.tokenize([attr]))
+
+    def _prefix_kv(self, condition_tensors: ConditionTensors, batch_size: int):
+        """Run the prepended conditions alone through both transformers and return their
+        key/value states, as tuples of (key, value) per layer."""
+        device = next(iter(self.parameters())).device
+        sequence = torch.zeros((batch_size, self.code_depth, 0), dtype=torch.long, device=device)
+        input_1 = self.emb[0](sequence[:, 0])
+        input_2 = sum([self.layer2_emb[k](sequence[:, k]) for k in range(1, self.code_depth)])
+        fused_input1, fused_input2 = self.fuser(input_1, input_2, condition_tensors)
+        output = self.transformer(inputs_embeds=fused_input1, use_cache=True, num_logits_to_keep=1)
+        fused_input2 = self.mlp(torch.cat([fused_input2, output.hidden_states], dim=-1))
+        output2 = self.transformer2(inputs_embeds=fused_input2, use_cache=True, num_logits_to_keep=1)
+        return output.past_key_values, output2.past_key_values
+
+    def _null_prefix_kv(self):
+        """Key/value states of the null-condition prefix, the same for every request, so they are
+        computed on first use and kept for the lifetime of the model (per device and dtype)."""
+        first_param = next(iter(self.parameters()))
+        if torch.is_autocast_enabled(first_param.device.type):
+            dtype = torch.get_autocast_dtype(first_param.device.type)
+        else:
+            dtype = first_param.dtype
+        key = (str(first_param.device), dtype)
+        if key not in self._null_prefix_cache:
+            # outside of the streaming state, this is not the first step of a generation
+            is_streaming = self.fuser._is_streaming
+            self.fuser._is_streaming = False
+            try:
+                self._null_prefix_cache[key] = self._prefix_kv(self._null_condition_tensors(), 1)
+            finally:
+                self.fuser._is_streaming = is_streaming
+        return self._null_prefix_cache[key]
+
+    def _prefill_prefix_cache(self, condition_tensors: ConditionTensors, batch_size: int,
+                              max_new_tokens: int, num_variations: int = 1) -> bool:
+        """Prefill the streaming key/value caches with the prefix of the conditional rows, computed
+        here, followed by the shared null-condition prefix for the unconditional rows.
+        With `num_variations`, the prefix of every sample is computed once and forked into that many
+        consecutive rows.
+        Returns False, leaving the state untouched, when the prefix cannot be split from the
+        sequence (conditions summed to the input, or conditions whose null version has another length).
+        """
+        if len(self.fuser.fuse2cond.get('sum', [])) > 0 or len(self.fuser.fuse2cond['prepend']) == 0:
+            return False
+        null_kv1, null_kv2 = self._null_prefix_kv()
+        prefix_len = sum(condition_tensors[cond][0].shape[1] for cond in self.fuser.fuse2cond['prepend'])
+        if prefix_len != null_kv1[0][0].shape[2]:
+            return False
+        # also marks the prepended conditions as consumed in the fuser streaming state
+        cond_kv1, cond_kv2 = self._prefix_kv(condition_tensors, batch_size)
+
+        num_rows = batch_size * num_variations
+
+        def merge(cond_kv, null_kv):
+            return [(torch.cat([k.repeat_interleave(num_variations, dim=0), nk.expand(num_rows, -1, -1, -1)], dim=0),
+                     torch.cat([v.repeat_interleave(num_variations, dim=0), nv.expand(num_rows, -1, -1, -1)], dim=0))
+                    for (k, v), (nk, nv) in zip(cond_kv, null_kv)]
+        self._streaming_state['past_key_values_1'] = StaticKVCache.from_legacy(merge(cond_kv1, null_kv1), max_new_tokens)
+        self._streaming_state['past_key_values_2'] = StaticKVCache.from_legacy(merge(cond_kv2, null_kv2), max_new_tokens)
+        return True
+
     def forward(self, 
                 sequence: torch.Tensor,
-                condition_tensors: ConditionTensors) -> torch.Tensor:
+                condition_tensors: ConditionTensors,
+                num_logits_to_keep: tp.Optional[int] = None) -> torch.Tensor:
         """Apply language model on sequence and conditions.
         Given a tensor of sequence of shape [B, K, S] with K the number of codebooks and
         S the sequence steps, return the logits with shape [B, card, K, S].
@@ -254,6 +350,9 @@ class LmModel(StreamingModule):
             indices (torch.Tensor): Indices of the codes to model.
             condition_tensors (dict[str, ConditionType], optional): Pre-computed conditioning
                 tensors, see `conditions`.
+            num_logits_to_keep (int, optional): Only compute the logits of the last positions
+                (S becomes `num_logits_to_keep`), the prefix and the rest of the sequence are
+                never projected on the vocabulary.
         Returns:
             torch.Tensor: Logits.
         """
@@ -266,7 +365,8 @@ class LmModel(StreamingModule):
         fused_input1, fused_input2 = self.fuser(input_1, input_2, condition_tensors)
         output = self.transformer(inputs_embeds=fused_input1, 
                                   use_cache=self._is_streaming, 
-                                  past_key_values=self._streaming_state.get('past_key_values_1', None))
+                                  past_key_values=self._streaming_state.get('past_key_values_1', None),
+                                  num_logits_to_keep=num_logits_to_keep)
         if self._is_streaming:
             self._streaming_state['past_key_values_1'] = output.past_key_values
         logits = output.logits # [B, S, card]
@@ -283,11 +383,14 @@ class LmModel(StreamingModule):
             if self._is_streaming:
                 self._streaming_state['past_key_values_2'] = output2.past_key_values
             
-            res_logits = torch.stack([self.linears[k](output2.hidden_states) for k in range(K - 1)], dim=1)  # [B, K, S, card] # [B, K, S, card]
+            hidden_states2 = output2.hidden_states
+            if num_logits_to_keep is not None:
+                hidden_states2 = hidden_states2[:, -num_logits_to_keep:]
+            res_logits = torch.stack([self.linears[k](hidden_states2) for k in range(K - 1)], dim=1)  # [B, K, S, card] # [B, K, S, card]
             logits = torch.cat([logits, res_logits], dim=1)  # [B, K, S, card]
         
         # remove the prefix from the model outputs
-        if len(self.fuser.fuse2cond['prepend']) > 0:
+        if num_logits_to_keep is None and len(self.fuser.fuse2cond['prepend']) > 0:
             logits = logits[:, :, -S:, :]
 
         return logits  # [B, K, S, card]
@@ -341,6 +444,7 @@ class LmModel(StreamingModule):
                  texts = None,
                  descriptions = None,
                  audio_qt_embs = None,
+                 prompt: tp.Optional[torch.Tensor] = None,
                  num_samples: tp.Optional[int] = None,
                  max_gen_len: int = 256,
                  use_sampling: bool = True,
@@ -350,13 +454,16 @@ class LmModel(StreamingModule):
                  cfg_coef: tp.Optional[float] = None,
                  check: bool = False,        
                  record_tokens: bool = True,
-                 record_window: int = 150
+                 record_window: int = 150,
+                 num_variations: int = 1,
+                 generator: tp.Union[torch.Generator, tp.List[torch.Generator], None] = None,
                  ) -> torch.Tensor:
         """Generate tokens sampling from the model given a prompt or unconditionally. Generation can
         be perform in a greedy fashion or using sampling with top K and top P strategies.
 
         Args:
-            prompt (torch.Tensor, optional): Prompt tokens of shape [B, K, T].
+            prompt (torch.Tensor, optional): Prompt tokens of shape [B * num_variations, K, T], the
+                generation continues them (they are prefilled in one step and returned in the output).
             conditions_tensors (list of ConditioningAttributes, optional): List of conditions.
             num_samples (int, optional): Number of samples to generate when no prompt and no conditions are given.
             max_gen_len (int): Maximum generation length.
@@ -367,8 +474,12 @@ class LmModel(StreamingModule):
             cfg_coeff (float, optional): Classifier-free guidance coefficient.
             check (bool): Whether to apply further checks on generated sequence.
             callback (Callback, optional): Callback function to report generation progress.
+            num_variations (int): Number of takes sampled for every sample. The conditions of a sample
+                are prefilled once and the takes decode as a batch from that shared state.
+            generator (torch.Generator or list of torch.Generator, optional): RNG of the sampling, the
+                global one if None. A list holds one generator per sample, drawing for its takes only.
         Returns:
-            torch.Tensor: Generated tokens.
+            torch.Tensor: Generated tokens, the `num_variations` takes of a sample being consecutive rows.
         """
         assert not self.training, "generation shouldn't be used in training mode."
         first_param = next(iter(self.parameters()))
@@ -380,28 +491,27 @@ class LmModel(StreamingModule):
             possible_num_samples.append(num_samples)
         elif texts:            
             possible_num_samples.append(len(texts))
-        elif audio_qt_embs:            
+        elif audio_qt_embs is not None:            
             possible_num_samples.append(len(audio_qt_embs))
         else:
             possible_num_samples.append(1)
         assert [x == possible_num_samples[0] for x in possible_num_samples], "Inconsistent inputs shapes"
         num_samples = possible_num_samples[0]
-        condition_tensors = self.prepare_condition_tensors(batch_size=1, text=texts, descriptions=descriptions, audio_qt_emb=audio_qt_embs, prepare_null_condition=True)
-        # 3) Prepare token pool
-        record_token_pool = None
-        if record_tokens:
-            record_token_pool = []
-            
+        # the null conditions are only prepared when their cached prefix cannot be used, see below
+        condition_tensors = self.prepare_condition_tensors(batch_size=num_samples, text=texts, descriptions=descriptions, audio_qt_emb=audio_qt_embs, prepare_null_condition=False)
         # 4) set up startoff patterns
-        start_offset = 0
+        start_offset = 0 if prompt is None else prompt.shape[-1]
         assert start_offset < max_gen_len, f"{start_offset}, {max_gen_len}"
         pattern = self.pattern_provider.get_pattern(max_gen_len)
         # this token is used as default value for codes that are not generated yet
         unknown_token = -1
         # we generate codes up to the max_gen_len that will be mapped to the pattern sequence
-        B = num_samples
+        B = num_samples * num_variations
         gen_codes = torch.full((B, self.code_depth, max_gen_len), 
                                unknown_token, dtype=torch.long, device=device)
+        if prompt is not None:
+            assert prompt.shape[0] == B, f"prompt of {prompt.shape[0]} rows for {B} generated sequences"
+            gen_codes[..., :start_offset] = prompt.to(device)
         # create the gen_sequence with proper interleaving from the pattern: [B, K, S]
         gen_sequence, indexes, mask = pattern.build_pattern_sequence(gen_codes, self.special_token_id)
         output_codes = torch.full_like(gen_sequence, self.code_size)
@@ -410,11 +520,35 @@ class LmModel(StreamingModule):
         start_offset_sequence = pattern.get_first_step_with_timesteps(start_offset)
         assert start_offset_sequence is not None
         is_end = torch.zeros((B, self.code_depth, 1)).bool().to(device)
-        ignore_tokens = audio_qt_embs[0][0]
-        ignore_tokens = ignore_tokens[ignore_tokens < 16384]
+        # every song may not sample the tokens of its own melody prompt on the first codebook
+        ignore_mask = torch.zeros((num_samples, self.code_size), dtype=torch.bool, device=device)
+        for b in range(num_samples):
+            ignore_tokens = audio_qt_embs[b][0]
+            ignore_tokens = ignore_tokens[ignore_tokens < 16384]
+            ignore_mask[b, ignore_tokens.to(device)] = True
+        ignore_mask = ignore_mask.repeat_interleave(num_variations, dim=0)
+        # top-k on the first codebook, argmax on the others (see `CodebookSampler.from_params`)
+        sampler = CodebookSampler.from_params(self.code_depth, use_sampling, temp, top_k, top_p, generator)
+        # counts of the tokens sampled in the last `record_window` steps, for the repetition penalty
+        repetition_window = None
+        if record_tokens:
+            repetition_window = RepetitionWindow(B, self.code_depth, self.code_size + 1, record_window, device=device)
         # 5) auto-regressive sampling
         with self.streaming():
             gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
+            # preallocated key/value caches holding the condition prefix and room for the whole song,
+            # the prefix of the unconditional rows is the shared null-condition one
+            if not self._prefill_prefix_cache(condition_tensors, num_samples, gen_sequence_len, num_variations):
+                # every take is prefilled on its own
+                if num_variations > 1:
+                    texts = [t for t in texts for _ in range(num_variations)] if texts is not None else None
+                    descriptions = [d for d in descriptions for _ in range(num_variations)] if descriptions is not None else None
+                    audio_qt_embs = audio_qt_embs.repeat_interleave(num_variations, dim=0)
+                condition_tensors = self.prepare_condition_tensors(batch_size=B, text=texts, descriptions=descriptions, audio_qt_emb=audio_qt_embs, prepare_null_condition=True)
+                self._streaming_state['past_key_values_1'] = StaticKVCache(
+                    self.transformer.config.num_hidden_layers, gen_sequence_len)
+                self._streaming_state['past_key_values_2'] = StaticKVCache(
+                    self.transformer2.config.num_hidden_layers, gen_sequence_len)
             prev_offset = 0
             for offset in tqdm(range(start_offset_sequence, gen_sequence_len)):
                 # get current sequence (note that the streaming API is providing the caching over previous offsets)
@@ -429,8 +563,9 @@ class LmModel(StreamingModule):
                 next_token = self._sample_next_token(
                     curr_sequence, condition_tensors, use_sampling, temp, top_k, top_p,
                     cfg_coef=cfg_coef, 
-                    sampled_token_pool=record_token_pool[-record_window:] if record_tokens else None,
-                    ignore_tokens = ignore_tokens
+                    repetition_window=repetition_window,
+                    ignore_mask = ignore_mask,
+                    sampler=sampler,
                     )
                 # ensure the tokens that should be masked are properly set to special_token_id
                 # as the model never output special_token_id
@@ -447,7 +582,7 @@ class LmModel(StreamingModule):
                 
                 # record sampled tokens in a window
                 if record_tokens:
-                    record_token_pool.append(next_token.squeeze())
+                    repetition_window.push(next_token[..., 0])  # [B, K]
                 if torch.all(is_end):
                     gen_sequence = gen_sequence[..., :offset+1]
                     break
@@ -479,8 +614,9 @@ class LmModel(StreamingModule):
                            top_k: int = 0,
                            top_p: float = 0.0,
                            cfg_coef: tp.Optional[float] = None,
-                           sampled_token_pool: tp.Optional[list] = None,
-                           ignore_tokens: tp.Optional[torch.tensor] = torch.tensor([])) -> torch.Tensor:
+                           repetition_window: tp.Optional[RepetitionWindow] = None,
+                           ignore_mask: tp.Optional[torch.Tensor] = None,
+                           sampler: tp.Optional[CodebookSampler] = None) -> torch.Tensor:
         """Sample next token from the model given a sequence and a set of conditions. The model supports
         multiple sampling strategies (greedy sampling, softmax, top-k, top-p...).
 
@@ -495,6 +631,11 @@ class LmModel(StreamingModule):
             top_k (int): K for "top-k" sampling.
             top_p (float): P for "top-p" sampling.
             cfg_coef (float, optional): classifier free guidance coefficient
+            repetition_window (RepetitionWindow, optional): Recently sampled tokens, whose logits are penalized.
+            ignore_mask (torch.Tensor, optional): Boolean mask of shape [B, card] of the tokens
+                that may not be sampled on the first codebook.
+            sampler (CodebookSampler, optional): Sampler built once per generation, else one is built
+                from `use_sampling`, `temp`, `top_k` and `top_p`.
         Returns:
             next_token (torch.Tensor): Next token tensor of shape [B, K, 1].
         """
@@ -504,8 +645,9 @@ class LmModel(StreamingModule):
         model = self if self._fsdp is None else self._fsdp
         
         # Preparing for CFG, predicting both conditional and unconditional logits.
+        # Only the last position is sampled, the others are never projected on the vocabulary.
         sequence = torch.cat([sequence, sequence], dim=0)
-        all_logits = model(sequence, condition_tensors=condition_tensors)
+        all_logits = model(sequence, condition_tensors=condition_tensors, num_logits_to_keep=1)
         cond_logits, uncond_logits = all_logits.split(B, dim=0)  # [B, K, T, card]
         logits = uncond_logits + (cond_logits - uncond_logits) * cfg_coef
 
@@ -513,28 +655,15 @@ class LmModel(StreamingModule):
         logits = logits[..., -1]  # [B x K x card]
         
         # add punishment to pre-sampled tokens
-        if sampled_token_pool is not None and len(sampled_token_pool) > 0:
-            sampled_token_pool = torch.stack(sampled_token_pool, -1) # [K, T]
-            for q in range(self.code_depth):
-                # q_count = torch.bincount(sampled_token_pool)
-                q_count = torch.bincount(torch.unique(sampled_token_pool[q]))
-                tmp = min(q_count.shape[-1], self.code_size - 1) 
-                logits[:, q, :tmp] /= (1.1 ** q_count[:tmp])
+        if repetition_window is not None:
+            # every token present in the window once, EOS excluded
+            repetition_window.penalize(logits, penalty=1.1, num_tokens=self.code_size - 1)
 
-        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
-        if(ignore_tokens is not None and len(ignore_tokens) > 0):
-            logits[0][0][ignore_tokens.to(torch.int)] = float('-inf')
-        if use_sampling and temp > 0.0:
-            probs = torch.softmax(logits / temp, dim=-1)
-            if top_p > 0.0:
-                next_token = sample_top_p(probs, p=top_p)
-            elif top_k > 0:
-                next_token_first = sample_top_k(probs[:,[0],:], k=top_k)
-                next_token_res = sample_top_k(probs[:,1:,:], k=1)
-                next_token = torch.cat([next_token_first,next_token_res], dim = 1)
-            else:
-                next_token = multinomial(probs, num_samples=1)
-        else:
-            next_token = torch.argmax(logits, dim=-1, keepdim=True)
+        # Mask the prompt tokens on the first codebook, then sample every codebook with its own strategy.
+        if ignore_mask is not None:
+            logits[:, 0].masked_fill_(ignore_mask, float('-inf'))
+        if sampler is None:
+            sampler = CodebookSampler.from_params(self.code_depth, use_sampling, temp, top_k, top_p)
+        next_token = sampler(logits)
 
         return next_token
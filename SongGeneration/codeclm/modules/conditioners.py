@@ -116,6 +116,8 @@ class QwTokenizerConditioner(TextConditioner):
         self.text_tokenizer = Qwen2Tokenizer.from_pretrained(token_path)
         if add_token_list != []:
             self.text_tokenizer.add_tokens(add_token_list, special_tokens=True)        
+        # songs of a batch are padded after their lyrics, the same way pad_2d_tensor pads up to max_len
+        self.text_tokenizer.padding_side = "right"
         voc_size = len(self.text_tokenizer.get_vocab())
         # here initialize a output_proj (nn.Embedding) layer
         super().__init__(voc_size, output_dim, input_token=True, padding_idx=151643) 
@@ -192,6 +194,7 @@ class QwTextConditioner(TextConditioner):
         
         from transformers import Qwen2Tokenizer
         self.text_tokenizer = Qwen2Tokenizer.from_pretrained(token_path)    
+        self.text_tokenizer.padding_side = "right"
         voc_size = len(self.text_tokenizer.get_vocab())         
         # here initialize a output_proj (nn.Embedding) layer
         super().__init__(voc_size, output_dim, input_token=True, padding_idx=151643) 
@@ -16,6 +16,27 @@ from third_party.demucs.models.pretrained import get_model_from_yaml
 from filelock import FileLock
 import kaldiio
 # os.path.join(args.model_dir, "htdemucs.pth"), os.path.join(args.model_dir, "htdemucs.yaml")
+
+
+def plan_windows(length, window, hop):
+    """(start, end) of the windows covering `length` frames, every window starting `hop` frames after the
+    previous one. The windows are `window` frames long but the last one, which stops at `length` instead of
+    running over frames that would be cut from the output; a single window when `length <= window`."""
+    if length <= window:
+        return [(0, length)]
+    num_windows = math.ceil((length - (window - hop)) / hop)
+    return [(start, min(start + window, length)) for start in range(0, num_windows * hop, hop)]
+
+
+def pad_frames(x, length, dim=-1):
+    """Zero-pad `x` to `length` frames along `dim`."""
+    if x.shape[dim] >= length:
+        return x
+    shape = list(x.shape)
+    shape[dim] = length - x.shape[dim]
+    return torch.cat([x, x.new_zeros(shape)], dim)
+
+
 class Separator:
     def __init__(self, dm_model_path='demucs/ckpt/htdemucs.pth', dm_config_path='demucs/ckpt/htdemucs.yaml', gpu_id=0) -> None:
         if torch.cuda.is_available() and gpu_id < torch.cuda.device_count():
@@ -144,26 +165,28 @@ class Tango:
         # 40秒对应10个token
         output_len = int(orig_length / float(self.sample_rate) * 25) + 1
 
-        while(audios_vocal.shape[-1] < min_samples):
-            audios_vocal = torch.cat([audios_vocal, audios_vocal], -1)
-            audios_bgm = torch.cat([audios_bgm, audios_bgm], -1)
-        int_max_len=audios_vocal.shape[-1]//min_samples+1
-        audios_vocal = torch.cat([audios_vocal, audios_vocal], -1)
-        audios_bgm = torch.cat([audios_bgm, audios_bgm], -1)
-        audios_vocal=audios_vocal[:,:int(int_max_len*(min_samples))]
-        audios_bgm=audios_bgm[:,:int(int_max_len*(min_samples))]
+        # the audio is repeated from its start (doubled until it covers a 40s chunk, plus one more copy) and
+        # encoded in 40s chunks; the chunks are gathered with a wrapped index rather than built by doubling,
+        # and the chunks past the codes that are kept are not encoded
+        repeated_length = orig_length
+        while(repeated_length < min_samples):
+            repeated_length = repeated_length * 2
+        int_max_len = repeated_length // min_samples + 1
         codes_vocal_list=[]
         codes_bgm_list=[]
+        num_codes = 0
 
-    
-
-        audio_vocal_input = audios_vocal.reshape(2, -1, min_samples).permute(1, 0, 2).reshape(-1, 2, min_samples)
-        audio_bgm_input = audios_bgm.reshape(2, -1, min_samples).permute(1, 0, 2).reshape(-1, 2, min_samples)
-
-        for audio_inx in range(0, audio_vocal_input.shape[0], batch_size):
-            [codes_vocal,codes_bgm], _, spk_embeds = self.model.fetch_codes_batch((audio_vocal_input[audio_inx:audio_inx+batch_size]), (audio_bgm_input[audio_inx:audio_inx+batch_size]), additional_feats=[],layer_vocal=self.layer_vocal,layer_bgm=self.layer_bgm)
+        audio_inx = 0
+        while audio_inx < int_max_len and num_codes < output_len:
+            num_chunks = min(batch_size, int_max_len - audio_inx, math.ceil((output_len - num_codes) / (40 * 25)))
+            wrapped = torch.arange(audio_inx * min_samples, (audio_inx + num_chunks) * min_samples, device=audios_vocal.device) % orig_length
+            audio_vocal_input = audios_vocal[:, wrapped].reshape(2, num_chunks, min_samples).permute(1, 0, 2)
+            audio_bgm_input = audios_bgm[:, wrapped].reshape(2, num_chunks, min_samples).permute(1, 0, 2)
+            [codes_vocal,codes_bgm], _, spk_embeds = self.model.fetch_codes_batch(audio_vocal_input, audio_bgm_input, additional_feats=[],layer_vocal=self.layer_vocal,layer_bgm=self.layer_bgm)
             codes_vocal_list.append(codes_vocal)
             codes_bgm_list.append(codes_bgm)
+            num_codes += codes_vocal.shape[0] * codes_vocal.shape[-1]
+            audio_inx += num_chunks
 
         codes_vocal = torch.cat(codes_vocal_list, 0).permute(1,0,2).reshape(1, -1)[None]
         codes_bgm = torch.cat(codes_bgm_list, 0).permute(1,0,2).reshape(1, -1)[None]
@@ -173,16 +196,85 @@ class Tango:
         return codes_vocal, codes_bgm
 
     @torch.no_grad()
-    def code2sound(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False):
-        codes_vocal,codes_bgm = codes
-        codes_vocal = codes_vocal.to(self.device)
-        codes_bgm = codes_bgm.to(self.device)
+    def code2sound(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False,
+                   solver='euler', guidance_interval=None, uncond_reuse=0, **solver_kwargs):
+        """Diffuse the codes into audio by windows of `duration` seconds. Every window integrates the flow in
+        `num_steps` steps of `solver` (see `ode_solvers`: euler, midpoint, heun, dpm_multistep, rk23), the
+        `solver_kwargs` (e.g. `rtol` of rk23) going to the solver. Guidance is only applied for t in
+        `guidance_interval` and the unconditional velocity is reused for `uncond_reuse` evaluations (see
+        `BASECFM.solve`)."""
+        return self.code2sound_batch([codes], [prompt_vocal], [prompt_bgm], duration=duration, guidance_scale=guidance_scale,
+                                     num_steps=num_steps, disable_progress=disable_progress, chunked=chunked, solver=solver,
+                                     guidance_interval=guidance_interval, uncond_reuse=uncond_reuse, **solver_kwargs)[0]
+
+    @torch.no_grad()
+    def code2sound_batch(self, codes_list, prompts_vocal=None, prompts_bgm=None, duration=40, guidance_scale=1.5, num_steps=20,
+                         disable_progress=False, chunked=False, solver='euler', guidance_interval=None, uncond_reuse=0,
+                         **solver_kwargs):
+        """`code2sound` of several songs, returned as a list of waveforms. The windows of a song depend on the
+        previous one, so window i of all the songs which have one is diffused as one batch, each song with its
+        own in-context frames (its prompt for the first window, the overlap with its previous window after).
+        Shorter songs leave the batch once their last window is done. The windows follow `plan_windows`: the
+        last one of a song is cut at its length, and when the songs of a batch have windows of different
+        lengths the shorter ones are padded with frames masked out of the attention."""
+        num_songs = len(codes_list)
+        prompts_vocal = [None] * num_songs if prompts_vocal is None else prompts_vocal
+        prompts_bgm = [None] * num_songs if prompts_bgm is None else prompts_bgm
 
         min_samples = duration * 25 # 40ms per frame
         hop_samples = min_samples // 4 * 3
         ovlp_samples = min_samples - hop_samples
         hop_frames = hop_samples
         ovlp_frames = ovlp_samples
+
+        songs = [self._prepare_song(codes, prompt_vocal, prompt_bgm, min_samples, hop_samples, ovlp_samples)
+                 for codes, prompt_vocal, prompt_bgm in zip(codes_list, prompts_vocal, prompts_bgm)]
+        latent_lists = [[] for _ in songs]
+        spk_embeds = torch.zeros([1, 32, 1, 32], device=self.device)
+        with torch.autocast(device_type="cuda", dtype=torch.float16):
+            num_windows = max(len(song['windows']) for song in songs)
+            for window in range(num_windows):
+                active = [i for i, song in enumerate(songs) if window < len(song['windows'])]
+                windows = [songs[i]['windows'][window] for i in active]
+                lengths = [end - start for start, end in windows]
+                latent_length = max(lengths)
+                codes_vocal_input = torch.cat([pad_frames(songs[i]['codes_vocal'][:,:,start:end], latent_length) for i, (start, end) in zip(active, windows)], 0)
+                codes_bgm_input = torch.cat([pad_frames(songs[i]['codes_bgm'][:,:,start:end], latent_length) for i, (start, end) in zip(active, windows)], 0)
+                if(window == 0):
+                    true_latent = torch.cat([pad_frames(songs[i]['first_latent'][:,0:length], latent_length, -2) for i, length in zip(active, lengths)], 0)
+                    incontext_length = [songs[i]['first_latent_length'] for i in active]
+                else:
+                    true_latents = []
+                    for i, length in zip(active, lengths):
+                        true_latent = latent_lists[i][-1][:,:,-ovlp_frames:].permute(0,2,1)
+                        len_add_to_1000 = length - true_latent.shape[-2]
+                        true_latent = torch.cat([true_latent, torch.randn(true_latent.shape[0],  len_add_to_1000, true_latent.shape[-1]).to(self.device)], -2)
+                        true_latents.append(pad_frames(true_latent, latent_length, -2))
+                    true_latent = torch.cat(true_latents, 0)
+                    incontext_length = [ovlp_frames for i in active]
+                if len(active) > 1:
+                    incontext_length = torch.tensor(incontext_length, device=self.device)
+                else:
+                    incontext_length = incontext_length[0]
+                if min(lengths) < latent_length:
+                    latent_length = torch.tensor(lengths, device=self.device)
+                latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, latent_length, incontext_length=incontext_length, additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg', solver=solver, guidance_interval=guidance_interval, uncond_reuse=uncond_reuse, **solver_kwargs)
+                for i, length, latent in zip(active, lengths, latents.split(1, 0)):
+                    latent_lists[i].append(latent[:,:,0:length])
+
+        min_samples =  int(min_samples * self.sample_rate // 1000 * 40)
+        hop_samples = int(hop_samples * self.sample_rate // 1000 * 40)
+        ovlp_samples = min_samples - hop_samples
+        torch.cuda.empty_cache()
+        return [self._latents_to_audio(latent_list, song['first_latent_length'], ovlp_samples, song['target_len'], chunked)
+                for song, latent_list in zip(songs, latent_lists)]
+
+    def _prepare_song(self, codes, prompt_vocal, prompt_bgm, min_samples, hop_samples, ovlp_samples):
+        """Codes of a song with its prompt codes in front, the first latent holding the prompt latents, and
+        the (start, end) frames of its windows."""
+        codes_vocal,codes_bgm = codes
+        codes_vocal = codes_vocal.to(self.device)
+        codes_bgm = codes_bgm.to(self.device)
         first_latent = torch.randn(codes_vocal.shape[0], min_samples, 64).to(self.device)
         first_latent_length = 0
         first_latent_codes_length = 0
@@ -228,47 +320,19 @@ class Tango:
         codes_len= codes_vocal.shape[-1]
         target_len = int((codes_len - first_latent_codes_length) / 100 * 4 * self.sample_rate)
         # target_len = int(codes_len / 100 * 4 * self.sample_rate)
-        # code repeat
-        if(codes_len < min_samples):
-            while(codes_vocal.shape[-1] < min_samples):
-                codes_vocal = torch.cat([codes_vocal, codes_vocal], -1)
-                codes_bgm = torch.cat([codes_bgm, codes_bgm], -1)
-
-            codes_vocal = codes_vocal[:,:,0:min_samples]
-            codes_bgm = codes_bgm[:,:,0:min_samples]
-        codes_len = codes_vocal.shape[-1]
-        if((codes_len - ovlp_samples) % hop_samples > 0):
-            len_codes=math.ceil((codes_len - ovlp_samples) / float(hop_samples)) * hop_samples + ovlp_samples
-            while(codes_vocal.shape[-1] < len_codes):
-                codes_vocal = torch.cat([codes_vocal, codes_vocal], -1)
-                codes_bgm = torch.cat([codes_bgm, codes_bgm], -1)
-            codes_vocal = codes_vocal[:,:,0:len_codes]
-            codes_bgm = codes_bgm[:,:,0:len_codes]
-        latent_length = min_samples
-        latent_list = []
-        spk_embeds = torch.zeros([1, 32, 1, 32], device=codes_vocal.device)
-        with torch.autocast(device_type="cuda", dtype=torch.float16):
-            for sinx in range(0, codes_vocal.shape[-1]-hop_samples, hop_samples):
-                codes_vocal_input=codes_vocal[:,:,sinx:sinx+min_samples]
-                codes_bgm_input=codes_bgm[:,:,sinx:sinx+min_samples]
-                if(sinx == 0):
-                    incontext_length = first_latent_length
-                    latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, first_latent, latent_length, incontext_length=incontext_length, additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
-                    latent_list.append(latents)
-                else:
-                    true_latent = latent_list[-1][:,:,-ovlp_frames:].permute(0,2,1)
-                    len_add_to_1000 = min_samples - true_latent.shape[-2]
-                    incontext_length = true_latent.shape[-2]
-                    true_latent = torch.cat([true_latent, torch.randn(true_latent.shape[0],  len_add_to_1000, true_latent.shape[-1]).to(self.device)], -2)
-                    latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, latent_length, incontext_length=incontext_length,  additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
-                    latent_list.append(latents)
+        return {
+            'codes_vocal': codes_vocal,
+            'codes_bgm': codes_bgm,
+            'first_latent': first_latent,
+            'first_latent_length': first_latent_length,
+            'target_len': target_len,
+            'windows': plan_windows(codes_len, min_samples, hop_samples),
+        }
 
+    def _latents_to_audio(self, latent_list, first_latent_length, ovlp_samples, target_len, chunked=False):
+        """Decode the latents of the windows of a song and cross-fade them into its waveform."""
         latent_list = [l.float() for l in latent_list]
         latent_list[0] = latent_list[0][:,:,first_latent_length:]
-        min_samples =  int(min_samples * self.sample_rate // 1000 * 40)
-        hop_samples = int(hop_samples * self.sample_rate // 1000 * 40)
-        ovlp_samples = min_samples - hop_samples
-        torch.cuda.empty_cache()
         with torch.no_grad():
             output = None
             for i in range(len(latent_list)):
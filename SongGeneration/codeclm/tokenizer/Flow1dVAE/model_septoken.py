@@ -23,6 +23,7 @@ from models_gpt.models.gpt2_config import GPT2Config
 
 from torch.cuda.amp import autocast
 from our_MERT_BESTRQ.test import load_model
+import ode_solvers
 
 class HubertModelWithFinalProj(HubertModel):
     def __init__(self, config):
@@ -146,41 +147,85 @@ class BASECFM(torch.nn.Module, ABC):
             mu (torch.Tensor): output of encoder
                 shape: (batch_size, n_channels, mel_timesteps, n_feats)
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        noise = x.clone()
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
-
-        for step in tqdm(range(1, len(t_span))):
-            x[:,0:incontext_length,:] = (1 - (1 - self.sigma_min) * t) * noise[:,0:incontext_length,:] + t * incontext_x[:,0:incontext_length,:]
-            if(guidance_scale > 1.0):
-
-                model_input = torch.cat([ \
-                    torch.cat([latent_mask_input, latent_mask_input], 0), \
-                    torch.cat([incontext_x, incontext_x], 0), \
-                    torch.cat([torch.zeros_like(mu), mu], 0), \
-                    torch.cat([x, x], 0), \
-                    ], 2)
-                timestep=t.unsqueeze(-1).repeat(2)
+        return self.solve(x, latent_mask_input, incontext_x, incontext_length, t_span, mu, attention_mask,
+                          guidance_scale, solver='euler', disable_progress=False)
 
-                dphi_dt = self.estimator(inputs_embeds=model_input, attention_mask=attention_mask,time_step=timestep).last_hidden_state
+    def solve(self, x, latent_mask_input, incontext_x, incontext_length, t_span, mu, attention_mask, guidance_scale,
+              solver='euler', disable_progress=True, guidance_interval=None, uncond_reuse=0, **solver_kwargs):
+        """
+        Integrate the flow from the noise `x` with one of the `ode_solvers` (euler, midpoint, heun,
+        dpm_multistep, rk23), `solver_kwargs` going to the solver. The first `incontext_length` frames are
+        not integrated: before every estimator evaluation they are set to the noisy `incontext_x` at that t.
+        `incontext_length` is shared by the batch, or a LongTensor [B] of the length of every row.
+
+        Classifier-free guidance is only applied for t in `guidance_interval` (t_min, t_max), the whole
+        trajectory when None, and the estimator runs on the conditional half alone elsewhere. With
+        `uncond_reuse` k, the unconditional velocity is computed once every k + 1 guided evaluations and
+        reused in between.
+        """
+        noise = x.clone()
+        batch_size, _, x_dim = x.shape
+        if(guidance_scale > 1.0):
+            # [unconditional; conditional] halves, the conditioning is written once and only x changes per step
+            model_input = torch.cat([ \
+                torch.cat([latent_mask_input, latent_mask_input], 0), \
+                torch.cat([incontext_x, incontext_x], 0), \
+                torch.cat([torch.zeros_like(mu), mu], 0), \
+                torch.cat([x, x], 0), \
+                ], 2)
+            x_input = model_input[:, :, -x_dim:].view(2, batch_size, *x.shape[1:])
+        else:
+            model_input = torch.cat([latent_mask_input, incontext_x, mu, x], 2)
+            x_input = model_input[:, :, -x_dim:].unsqueeze(0)
+        timestep = torch.empty(model_input.shape[0], device=x.device)
+        cfg_attention_mask = attention_mask
+        if guidance_scale > 1.0 and batch_size > 1:
+            cfg_attention_mask = torch.cat([attention_mask, attention_mask], 0)
+        incontext_mask = None
+        if isinstance(incontext_length, torch.Tensor) and incontext_length.dim() > 0:
+            frames = torch.arange(x.shape[1], device=x.device)
+            incontext_mask = (frames[None] < incontext_length.to(x.device)[:, None]).unsqueeze(-1)
+        t_min, t_max = (0.0, 1.0) if guidance_interval is None else guidance_interval
+        uncond = {'velocity': None, 'age': 0}
+
+        def velocity(x, t):
+            if incontext_mask is None:
+                x[:,0:incontext_length,:] = (1 - (1 - self.sigma_min) * t) * noise[:,0:incontext_length,:] + t * incontext_x[:,0:incontext_length,:]
+            else:
+                x.copy_(torch.where(incontext_mask, (1 - (1 - self.sigma_min) * t) * noise + t * incontext_x, x))
+            x_input.copy_(x.unsqueeze(0).expand_as(x_input))
+            timestep.fill_(t)
+            guided = guidance_scale > 1.0 and t_min <= t <= t_max
+            if guided and (uncond['velocity'] is None or uncond['age'] >= uncond_reuse):
+                dphi_dt = self.estimator(inputs_embeds=model_input, attention_mask=cfg_attention_mask,time_step=timestep).last_hidden_state
                 dphi_dt_uncond, dhpi_dt_cond = dphi_dt.chunk(2,0)
+                uncond['velocity'], uncond['age'] = dphi_dt_uncond, 0
+            else:
+                # the conditional half (or whole batch without guidance) alone
+                cond_input = model_input[batch_size:] if guidance_scale > 1.0 else model_input
+                cond_timestep = timestep[batch_size:] if guidance_scale > 1.0 else timestep
+                dhpi_dt_cond = self.estimator(inputs_embeds=cond_input, attention_mask=attention_mask,time_step=cond_timestep).last_hidden_state
+                dphi_dt_uncond = uncond['velocity']
+                if guided:
+                    uncond['age'] += 1
+                else:
+                    # not reused across an unguided part of the trajectory
+                    uncond['velocity'] = None
+            if guided:
                 dphi_dt = dphi_dt_uncond + guidance_scale * (dhpi_dt_cond - dphi_dt_uncond)
             else:
-                model_input = torch.cat([latent_mask_input, incontext_x, mu, x], 2)
-                timestep=t.unsqueeze(-1)
-                dphi_dt = self.estimator(inputs_embeds=model_input, attention_mask=attention_mask,time_step=timestep).last_hidden_state
-            
+                dphi_dt = dhpi_dt_cond
+
             dphi_dt = dphi_dt[: ,:, -x.shape[2]:]
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            # the in-context frames follow t, whatever the solver does with them
+            if incontext_mask is None:
+                dphi_dt[:,0:incontext_length,:] = 0
+            else:
+                dphi_dt = dphi_dt.masked_fill(incontext_mask, 0)
+            return dphi_dt
 
-        return sol[-1]
+        return ode_solvers.solve(solver, velocity, x, t_span, sigma_min=self.sigma_min,
+                                 disable_progress=disable_progress, **solver_kwargs)
 
     def projection_loss(self,hidden_proj, bestrq_emb):
         bsz = hidden_proj.shape[0]
@@ -580,7 +625,8 @@ class PromptCondAudioDiffusion(nn.Module):
     @torch.no_grad()
     def inference_codes(self, codes, spk_embeds, true_latents, latent_length, additional_feats,incontext_length=127, 
                   guidance_scale=2, num_steps=20,
-                  disable_progress=True, scenario='start_seg'):
+                  disable_progress=True, scenario='start_seg', solver='euler', guidance_interval=None, uncond_reuse=0,
+                  **solver_kwargs):
         classifier_free_guidance = guidance_scale > 1.0
         device = self.device
         dtype = self.dtype
@@ -607,9 +653,18 @@ class PromptCondAudioDiffusion(nn.Module):
 
 
         latent_masks = torch.zeros(latents.shape[0], latents.shape[1], dtype=torch.int64, device=latents.device)
-        latent_masks[:,0:latent_length] = 2
+        frames = torch.arange(latent_masks.shape[1], device=latent_masks.device)
+        if isinstance(latent_length, torch.Tensor) and latent_length.dim() > 0:
+            # a length per row, the frames after it are padding masked out of the attention
+            latent_masks[frames[None] < latent_length.to(latent_masks.device)[:, None]] = 2
+        else:
+            latent_masks[:,0:latent_length] = 2
         if(scenario=='other_seg'):
-            latent_masks[:,0:incontext_length] = 1
+            if isinstance(incontext_length, torch.Tensor) and incontext_length.dim() > 0:
+                # a length per row, e.g. songs with prompts of different lengths decoded together
+                latent_masks[frames[None] < incontext_length.to(latent_masks.device)[:, None]] = 1
+            else:
+                latent_masks[:,0:incontext_length] = 1
 
         
 
@@ -620,8 +675,11 @@ class PromptCondAudioDiffusion(nn.Module):
         true_latents = true_latents.permute(0,2,1).contiguous()
         true_latents = self.normfeat.project_sample(true_latents)
         true_latents = true_latents.permute(0,2,1).contiguous()
-        incontext_latents = true_latents * ((latent_masks > 0.5) * (latent_masks < 1.5)).unsqueeze(-1).float()
-        incontext_length = ((latent_masks > 0.5) * (latent_masks < 1.5)).sum(-1)[0]
+        incontext_mask = ((latent_masks > 0.5) * (latent_masks < 1.5)).unsqueeze(-1)
+        incontext_latents = true_latents * incontext_mask.float()
+        incontext_length = incontext_mask.sum((1, 2))
+        if batch_size == 1:
+            incontext_length = incontext_length[0]
 
 
         attention_mask=(latent_masks > 0.5)
@@ -640,9 +698,11 @@ class PromptCondAudioDiffusion(nn.Module):
 
         temperature = 1.0
         t_span = torch.linspace(0, 1, num_steps + 1, device=quantized_bestrq_emb.device)
-        latents = self.cfm_wrapper.solve_euler(latents * temperature, latent_mask_input,incontext_latents, incontext_length, t_span, additional_model_input,attention_mask,  guidance_scale)
+        latents = self.cfm_wrapper.solve(latents * temperature, latent_mask_input,incontext_latents, incontext_length, t_span, additional_model_input,attention_mask,  guidance_scale,
+                                         solver=solver, disable_progress=disable_progress, guidance_interval=guidance_interval,
+                                         uncond_reuse=uncond_reuse, **solver_kwargs)
 
-        latents[:,0:incontext_length,:] = incontext_latents[:,0:incontext_length,:]
+        latents = torch.where(incontext_mask, incontext_latents, latents)
         latents = latents.permute(0,2,1).contiguous()
         latents = self.normfeat.return_sample(latents)
         # latents = latents.permute(0,2,1).contiguous()
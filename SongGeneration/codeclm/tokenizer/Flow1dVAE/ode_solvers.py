@@ -0,0 +1,122 @@
+"""
+ODE solvers of the flow-matching decoders (`BASECFM`), integrating dx/dt = v(x, t) from the noise at
+`t_span[0]` to the latents at `t_span[-1]`. `velocity(x, t)` is one estimator evaluation (NFE), t a float.
+
+- 'euler': fixed-step Euler, 1 NFE per step (the reference);
+- 'midpoint', 'heun': fixed-step second-order Runge-Kutta, 2 NFEs per step;
+- 'dpm_multistep': DPM-Solver++(2M) written for the flow-matching path x_t = (1 - (1 - sigma_min) t) x_0 + t x_1,
+  second order from the velocities of the last two steps, 1 NFE per step;
+- 'rk23': adaptive Bogacki-Shampine, the step starts at the first step of `t_span` and follows the local error.
+
+Solvers may write into `x` and the states they pass to `velocity`.
+"""
+import math
+import typing as tp
+
+import torch
+from tqdm import tqdm
+
+
+Velocity = tp.Callable[[torch.Tensor, float], torch.Tensor]
+
+
+def _times(t_span) -> tp.List[float]:
+    return t_span.tolist() if isinstance(t_span, torch.Tensor) else [float(t) for t in t_span]
+
+
+def euler(velocity: Velocity, x: torch.Tensor, t_span, disable_progress: bool = True, **kwargs) -> torch.Tensor:
+    times = _times(t_span)
+    for t, t_next in tqdm(list(zip(times[:-1], times[1:])), disable=disable_progress):
+        x.add_(velocity(x, t), alpha=t_next - t)
+    return x
+
+
+def midpoint(velocity: Velocity, x: torch.Tensor, t_span, disable_progress: bool = True, **kwargs) -> torch.Tensor:
+    times = _times(t_span)
+    for t, t_next in tqdm(list(zip(times[:-1], times[1:])), disable=disable_progress):
+        h = t_next - t
+        x_mid = x + 0.5 * h * velocity(x, t)
+        x = x + h * velocity(x_mid, t + 0.5 * h)
+    return x
+
+
+def heun(velocity: Velocity, x: torch.Tensor, t_span, disable_progress: bool = True, **kwargs) -> torch.Tensor:
+    times = _times(t_span)
+    for t, t_next in tqdm(list(zip(times[:-1], times[1:])), disable=disable_progress):
+        h = t_next - t
+        v = velocity(x, t)
+        v_next = velocity(x + h * v, t_next)
+        x = x + 0.5 * h * (v + v_next)
+    return x
+
+
+def dpm_multistep(velocity: Velocity, x: torch.Tensor, t_span, sigma_min: float = 0.0,
+                  disable_progress: bool = True, **kwargs) -> torch.Tensor:
+    """DPM-Solver++(2M) in data prediction: with alpha_t = t and sigma_t = 1 - (1 - sigma_min) t, the
+    predicted latents are x_1 = (1 - sigma_min) x_t + sigma_t v. The first-order update is exactly an Euler
+    step, the first step (alpha = 0, lambda = -inf) and a last step to sigma = 0 are first order."""
+    times = _times(t_span)
+    alpha = lambda t: t
+    sigma = lambda t: 1 - (1 - sigma_min) * t
+    lambda_ = lambda t: math.log(alpha(t)) - math.log(sigma(t))
+    prev = None   # (lambda, predicted x_1) of the previous step
+    for t, t_next in tqdm(list(zip(times[:-1], times[1:])), disable=disable_progress):
+        v = velocity(x, t)
+        data = (1 - sigma_min) * x + sigma(t) * v
+        coef = alpha(t_next) - sigma(t_next) * alpha(t) / sigma(t)
+        if prev is None or sigma(t_next) <= 0:
+            update = data
+        else:
+            h = lambda_(t_next) - lambda_(t)
+            r = (lambda_(t) - prev[0]) / h
+            update = data + (data - prev[1]) / (2 * r)
+        x = sigma(t_next) / sigma(t) * x + coef * update
+        prev = (lambda_(t), data) if alpha(t) > 0 else None
+    return x
+
+
+def rk23(velocity: Velocity, x: torch.Tensor, t_span, rtol: float = 1e-2, atol: float = 1e-2,
+         max_steps: int = 100, disable_progress: bool = True, **kwargs) -> torch.Tensor:
+    """Adaptive Bogacki-Shampine 3(2) with first-same-as-last, 3 NFEs per accepted step. A step is accepted
+    when the RMS of the error scaled by `atol + rtol * |x|` is below 1; after `max_steps` tries (or below
+    a step of span / max_steps) the steps are accepted regardless of the error."""
+    times = _times(t_span)
+    t, t_end = times[0], times[-1]
+    h = times[1] - times[0]
+    min_step = (t_end - t) / max_steps
+    v = velocity(x, t)
+    num_steps = 0
+    with tqdm(total=t_end - t, disable=disable_progress) as progress:
+        while t_end - t > 1e-6:
+            h = min(h, t_end - t)
+            k2 = velocity(x + 0.5 * h * v, t + 0.5 * h)
+            k3 = velocity(x + 0.75 * h * k2, t + 0.75 * h)
+            x_new = x + h * (2 / 9 * v + 1 / 3 * k2 + 4 / 9 * k3)
+            v_new = velocity(x_new, t + h)
+            error = h * (-5 / 72 * v + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * v_new)
+            scale = atol + rtol * torch.maximum(x.abs(), x_new.abs())
+            norm = (error.float() / scale.float()).pow(2).mean().sqrt().item()
+            num_steps += 1
+            if norm <= 1 or h <= min_step or num_steps >= max_steps:
+                x, v, t = x_new, v_new, t + h
+                progress.update(h)
+            factor = 5.0 if norm == 0 else min(5.0, max(0.2, 0.9 * norm ** (-1 / 3)))
+            h = max(h * factor, min_step)
+    return x
+
+
+SOLVERS: tp.Dict[str, tp.Callable[..., torch.Tensor]] = {
+    'euler': euler,
+    'midpoint': midpoint,
+    'heun': heun,
+    'dpm_multistep': dpm_multistep,
+    'rk23': rk23,
+}
+
+
+def solve(solver: str, velocity: Velocity, x: torch.Tensor, t_span, **kwargs) -> torch.Tensor:
+    """Integrate from `x` at `t_span[0]` to `t_span[-1]` with `solver`, one of `SOLVERS`. The extra
+    arguments (`sigma_min`, `rtol`, ...) are passed to the solver, which ignores the ones it does not use."""
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown ODE solver {solver}, expected one of {list(SOLVERS)}")
+    return SOLVERS[solver](velocity, x, t_span, **kwargs)
@@ -113,7 +113,7 @@ class Flow1dVAE1rvq(AudioTokenizer):
 
         from codeclm.tokenizer.Flow1dVAE.generate_1rvq import Tango
         model_path = model_type
-        self.model = Tango(model_path=model_path, vae_config=vae_config, vae_model=vae_model, device='cuda')
+        self.model = Tango(model_path=model_path, vae_config=vae_config, vae_model=vae_model, device='cuda' if torch.cuda.is_available() else 'cpu')
         print ("Successfully loaded checkpoint from:", model_path)
 
             
@@ -188,7 +188,7 @@ class Flow1dVAESeparate(AudioTokenizer):
 
         from codeclm.tokenizer.Flow1dVAE.generate_septoken import Tango
         model_path = model_type
-        self.model = Tango(model_path=model_path, vae_config=vae_config, vae_model=vae_model, device='cuda')
+        self.model = Tango(model_path=model_path, vae_config=vae_config, vae_model=vae_model, device='cuda' if torch.cuda.is_available() else 'cpu')
         print ("Successfully loaded checkpoint from:", model_path)
 
             
@@ -208,11 +208,24 @@ class Flow1dVAESeparate(AudioTokenizer):
         return codes_vocal, codes_bgm
     
     @torch.no_grad()    
-    def decode(self, codes: torch.Tensor, prompt_vocal = None, prompt_bgm = None, chunked=False):
+    def decode(self, codes: torch.Tensor, prompt_vocal = None, prompt_bgm = None, chunked=False,
+               num_steps=50, solver='euler', guidance_interval=None, uncond_reuse=0, **solver_kwargs):
         wav = self.model.code2sound(codes, prompt_vocal=prompt_vocal, prompt_bgm=prompt_bgm, guidance_scale=1.5, 
-                                    num_steps=50, disable_progress=False, chunked=chunked) # [B,N,T] -> [B,T]
+                                    num_steps=num_steps, disable_progress=False, chunked=chunked,
+                                    solver=solver, guidance_interval=guidance_interval, uncond_reuse=uncond_reuse,
+                                    **solver_kwargs) # [B,N,T] -> [B,T]
         return wav[None]
 
+    @torch.no_grad()
+    def decode_batch(self, codes_list: tp.List[tp.List[torch.Tensor]], prompts_vocal = None, prompts_bgm = None, chunked=False,
+                     num_steps=50, solver='euler', guidance_interval=None, uncond_reuse=0, **solver_kwargs):
+        """`decode` of several songs, their diffusion windows being batched together."""
+        wavs = self.model.code2sound_batch(codes_list, prompts_vocal=prompts_vocal, prompts_bgm=prompts_bgm, guidance_scale=1.5,
+                                           num_steps=num_steps, disable_progress=False, chunked=chunked,
+                                           solver=solver, guidance_interval=guidance_interval, uncond_reuse=uncond_reuse,
+                                           **solver_kwargs)
+        return [wav[None] for wav in wavs]
+
     
     @torch.no_grad()
     def decode_latent(self, codes: torch.Tensor):
@@ -26,7 +26,7 @@ os.environ['TOKENIZERS_PARALLELISM'] = "false"
 
 
 class CodecLM_PL(pl.LightningModule):
-    def __init__(self, cfg, ckpt_path):
+    def __init__(self, cfg, ckpt_path, lm_device='cpu', lm_dtype=None):
         super().__init__()
 
         self.cfg = cfg
@@ -44,11 +44,18 @@ class CodecLM_PL(pl.LightningModule):
             self.seperate_tokenizer = None
         
         # 2) Build LM
-        self.audiolm = builders.get_lm_model(self.cfg)
+        if ckpt_path.endswith('.safetensors'):
+            # no allocation nor random init, the weights are read memory-mapped straight to lm_device
+            self.audiolm = builders.get_lm_model(self.cfg, device='meta')
+        else:
+            self.audiolm = builders.get_lm_model(self.cfg)
         print(self.audiolm)
         # 3) Load pretrained checkpoint (if any)
-        checkpoint = torch.load(ckpt_path, map_location='cpu')
-        missing, unexpected = self.load_state_dict(checkpoint, strict=False)
+        if ckpt_path.endswith('.safetensors'):
+            missing, unexpected = self.load_safetensors(ckpt_path, lm_device, lm_dtype)
+        else:
+            checkpoint = torch.load(ckpt_path, map_location='cpu')
+            missing, unexpected = self.load_state_dict(checkpoint, strict=False)
         print(f'-------------Missing--------------\n{missing}')
         print(f'-------------Unexpected--------------\n{unexpected}')
         print("successfully load deepspeed pretrained model {}".format(ckpt_path))
@@ -72,6 +79,28 @@ class CodecLM_PL(pl.LightningModule):
         self.epoch = 0
         print("++++++++++++++++ training <song> +++++++++++++++++")
 
+    def load_safetensors(self, ckpt_path, lm_device='cpu', lm_dtype=None):
+        """Load a checkpoint converted by `convert_ckpt.py`. The LM (built on the meta device) takes the
+        tensors as they are read on `lm_device` in `lm_dtype`, the other modules are loaded as usual."""
+        from safetensors import safe_open
+        lm_state, other_state = {}, {}
+        with safe_open(ckpt_path, framework='pt', device=str(lm_device)) as f:
+            for key in f.keys():
+                tensor = f.get_tensor(key)
+                if key.startswith('audiolm.'):
+                    if lm_dtype is not None and tensor.is_floating_point():
+                        tensor = tensor.to(lm_dtype)
+                    lm_state[key[len('audiolm.'):]] = tensor
+                else:
+                    other_state[key] = tensor
+        missing, unexpected = builders.load_lm_weights(self.audiolm, lm_state, lm_device, lm_dtype)
+        missing = [f'audiolm.{k}' for k in missing]
+        unexpected = [f'audiolm.{k}' for k in unexpected]
+        if other_state:
+            _, other_unexpected = self.load_state_dict(other_state, strict=False)
+            unexpected += other_unexpected
+        return missing, unexpected
+
     # TODO: move this part to loader
     def generate_mask_and_end_token(self, x, sequence_lengths, end_id=16384):
         batch_size = sequence_lengths.size(0)
@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+import typing as tp
+
+import torch
+import torchaudio
+
+from .token_store import file_digest
+
+
+def save_audio(path: str, wav: torch.Tensor, sample_rate: int) -> str:
+    """Write `wav` [C, T] to `path` through a temporary file renamed in place, so that `path`
+    is never left half written by a crash. Returns the sha256 of the written file."""
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+    torchaudio.save(tmp_path, wav, sample_rate, format=ext.lstrip('.') or None)
+    digest = file_digest(tmp_path)
+    os.replace(tmp_path, path)
+    return digest
+
+
+class GenerationJournal:
+    """Append-only journal of the songs of a generation run, one line per finished song written
+    as soon as its audio is saved, so that an interrupted run loses nothing of what it finished.
+
+    Every line holds the output item and the sha256 of its audio. With `resume`, the lines of a
+    previous run are loaded and a song counts as done when its audio is still on disk with the
+    same checksum; otherwise the journal is started over.
+
+    Args:
+        path (str): Path of the journal file.
+        resume (bool): Keep and load the entries of a previous run.
+    """
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: tp.Dict[str, dict] = {}
+        if resume and os.path.exists(path):
+            self._drop_partial_line()
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['idx']] = entry
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _drop_partial_line(self):
+        """Cut the journal after its last newline: a crash may have left a half-written last line,
+        which the next entry would otherwise be appended to and lost with."""
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+
+    def is_done(self, idx: tp.Any) -> bool:
+        """Whether song `idx` was journaled and its audio is on disk, unchanged."""
+        entry = self.entries.get(f"{idx}")
+        if entry is None:
+            return False
+        wav_path = entry['item']['wav_path']
+        return os.path.exists(wav_path) and file_digest(wav_path) == entry['sha256']
+
+    def record(self, item: dict, sha256: str):
+        """Journal the output `item` of a song whose audio has the checksum `sha256`."""
+        entry = {'idx': f"{item['idx']}", 'sha256': sha256, 'item': item}
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[entry['idx']] = entry
+
+    def items(self, order: tp.Iterable[tp.Any]) -> tp.List[dict]:
+        """Journaled output items of the songs `order`, in that order, skipping the ones not done
+        (including those whose audio was deleted or changed since it was journaled)."""
+        return [self.entries[f"{idx}"]['item'] for idx in order if self.is_done(idx)]
+
+
+def write_manifest(path: str, items: tp.List[dict]):
+    """Write the output items as JSONL, replacing `path` only once the new file is complete."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding='utf-8') as fw:
+        for item in items:
+            fw.write(json.dumps(item, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,101 @@
+import queue
+import threading
+import typing as tp
+
+
+class Stage:
+    """One step of a `Pipeline`.
+
+    Args:
+        name (str): Name of the stage, used in error messages.
+        fn (callable): Function applied to every work item, its result is handed to the next stage.
+        num_workers (int): Number of threads running `fn` concurrently. Only use more than one
+            worker when `fn` is thread safe.
+    """
+    def __init__(self, name: str, fn: tp.Callable[[tp.Any], tp.Any], num_workers: int = 1):
+        assert num_workers >= 1, f"stage {name} needs at least one worker, got {num_workers}"
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+
+
+_STOP = object()
+
+
+class Pipeline:
+    """Run work items through a chain of stages, every stage having its own worker threads.
+    Stages are connected by bounded queues so that a fast stage cannot run too far ahead
+    of a slow one (and hold too many intermediate results in memory). While the last stage
+    works on item N, the previous ones already work on items N+1, N+2...
+
+    Args:
+        stages (list of Stage): The stages, in order.
+        queue_size (int): Maximum number of items waiting between two stages.
+    """
+    def __init__(self, stages: tp.List[Stage], queue_size: int = 1):
+        assert len(stages) > 0, "a pipeline needs at least one stage"
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, inputs: tp.Iterable[tp.Any]) -> tp.List[tp.Any]:
+        """Process all the inputs and return the outputs of the last stage, in the order of the inputs.
+        If a stage raises, the remaining items are dropped and the first error is raised again here.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = {}
+        errors = []
+        lock = threading.Lock()
+        failed = threading.Event()
+        alive = [stage.num_workers for stage in self.stages]
+
+        def work(i: int):
+            stage = self.stages[i]
+            while True:
+                task = queues[i].get()
+                if task is _STOP:
+                    break
+                index, value = task
+                if failed.is_set():
+                    # keep draining so that upstream stages never block on a full queue
+                    continue
+                try:
+                    value = stage.fn(value)
+                except Exception as e:
+                    with lock:
+                        errors.append((stage.name, index, e))
+                    failed.set()
+                    continue
+                if i + 1 < len(self.stages):
+                    queues[i + 1].put((index, value))
+                else:
+                    with lock:
+                        results[index] = value
+            with lock:
+                alive[i] -= 1
+                last = alive[i] == 0
+            if last and i + 1 < len(self.stages):
+                for _ in range(self.stages[i + 1].num_workers):
+                    queues[i + 1].put(_STOP)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for w in range(stage.num_workers):
+                thread = threading.Thread(target=work, args=(i,), name=f"{stage.name}-{w}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        num_inputs = 0
+        for value in inputs:
+            if failed.is_set():
+                break
+            queues[0].put((num_inputs, value))
+            num_inputs += 1
+        for _ in range(self.stages[0].num_workers):
+            queues[0].put(_STOP)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            name, index, e = errors[0]
+            raise RuntimeError(f"stage {name} failed on item {index}") from e
+        return [results[i] for i in range(num_inputs)]
@@ -0,0 +1,107 @@
+import os
+import json
+import typing as tp
+
+import numpy as np
+import torch
+
+
+AUTO = 'Auto'
+
+
+def _source_stamp(prompt_path: str) -> tp.Dict[str, int]:
+    stat = os.stat(prompt_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def pack_prompt_bank(prompt_path: str, root: str):
+    """One-time conversion of a `prompt.pt` (dict of prompt type -> list of [1, 3, T] token tensors)
+    into a prompt bank folder: `tokens.npy`, all the prompts concatenated along time into one
+    int16 [3, total_T] array, and `index.json`, the (start, length) of every prompt per type and the
+    size and mtime of `prompt_path`. Both files are written under names of this process and renamed,
+    `index.json` last, so that concurrent packers and readers never see a partial or mismatched bank.
+    """
+    source = _source_stamp(prompt_path)
+    auto_prompt = torch.load(prompt_path, map_location='cpu')
+    chunks = []
+    index = {}
+    start = 0
+    for prompt_type, prompts in auto_prompt.items():
+        spans = []
+        for prompt in prompts:
+            codes = prompt[0].numpy()
+            assert codes.min() >= 0 and codes.max() < 2 ** 15, "prompt tokens do not fit in int16"
+            chunks.append(codes.astype(np.int16))
+            spans.append([start, codes.shape[-1]])
+            start += codes.shape[-1]
+        index[prompt_type] = spans
+    os.makedirs(root, exist_ok=True)
+    tmp_path = os.path.join(root, f'tokens.npy.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.concatenate(chunks, axis=-1))
+    os.replace(tmp_path, os.path.join(root, 'tokens.npy'))
+    tmp_path = os.path.join(root, f'index.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'source': source, 'prompts': index}, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(root, 'index.json'))
+
+
+def _read_index(root: str) -> tp.Optional[tp.Dict[str, tp.Any]]:
+    path = os.path.join(root, 'index.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class PromptBank:
+    """Memory-mapped bank of the auto prompts written by `pack_prompt_bank`.
+
+    Nothing is read from disk until a prompt is used, and prompts are returned as views of the
+    mapped array, so that opening the bank is instant and every worker process shares the same
+    pages. The 'Auto' type samples among all the prompts, in the order of the other types.
+
+    Args:
+        root (str): Folder of the bank.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.index: tp.Dict[str, tp.List[tp.List[int]]] = _read_index(root)['prompts']
+        # copy-on-write mapping: writable for torch.from_numpy, never written back to the file
+        self.tokens = np.load(os.path.join(root, 'tokens.npy'), mmap_mode='c')
+        self.index[AUTO] = [span for spans in self.index.values() for span in spans]
+
+    @property
+    def types(self) -> tp.List[str]:
+        return list(self.index.keys())
+
+    def __contains__(self, prompt_type: str) -> bool:
+        return prompt_type in self.index
+
+    def num_prompts(self, prompt_type: str) -> int:
+        return len(self.index[prompt_type])
+
+    def get(self, prompt_type: str, index: int) -> torch.Tensor:
+        """Prompt `index` of `prompt_type`, an int16 [1, 3, T] view of the bank (no copy)."""
+        start, length = self.index[prompt_type][index]
+        return torch.from_numpy(self.tokens[:, start:start + length])[None]
+
+    def sample(self, prompt_type: str, rng: tp.Any = np.random) -> tp.Tuple[int, torch.Tensor]:
+        """Random prompt of `prompt_type`, returned with its index."""
+        index = int(rng.randint(0, self.num_prompts(prompt_type)))
+        return index, self.get(prompt_type, index)
+
+
+def load_prompt_bank(prompt_path: str = 'ckpt/prompt.pt', root: tp.Optional[str] = None) -> PromptBank:
+    """Open the prompt bank packed next to `prompt_path`, packing it on first use and again when
+    `prompt_path` changed since (or the bank predates the recorded source). Without `prompt_path`
+    an existing bank is used as is."""
+    if root is None:
+        root = os.path.splitext(prompt_path)[0] + '_bank'
+    index = _read_index(root)
+    if os.path.exists(prompt_path):
+        if index is None or index.get('source') != _source_stamp(prompt_path):
+            pack_prompt_bank(prompt_path, root)
+    elif index is None or 'prompts' not in index:
+        raise FileNotFoundError(f"no prompt bank in {root} and no {prompt_path} to pack it from")
+    return PromptBank(root)
@@ -0,0 +1,86 @@
+import os
+import threading
+import typing as tp
+from collections import OrderedDict
+
+import torch
+
+
+class PromptAudioCache:
+    """Cache of what is computed from a reference track, keyed by the sha256 of its content
+    (see `codeclm.utils.token_store.file_digest`): the separated 10 s waveforms ('wavs') and their
+    1rvq and septoken codes ('codes'). Every entry is a dict of CPU tensors.
+
+    Recently used entries are kept in memory, and, with a `root` folder, saved as `<digest>_<name>.pt`
+    files. Both levels evict the least recently used entries first.
+
+    Args:
+        root (str, optional): Folder of the disk cache, memory only if None.
+        max_memory_entries (int): Number of entries kept in memory.
+        max_disk_bytes (int): Total size of the files kept in `root`.
+    """
+    def __init__(self, root: tp.Optional[str] = None, max_memory_entries: int = 32,
+                 max_disk_bytes: int = 2 * 1024 ** 3):
+        self.root = root
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: tp.OrderedDict[tp.Tuple[str, str], tp.Dict[str, torch.Tensor]] = OrderedDict()
+        self.lock = threading.Lock()
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+
+    def _path(self, digest: str, name: str) -> str:
+        return os.path.join(self.root, f"{digest}_{name}.pt")
+
+    def get(self, digest: str, name: str) -> tp.Optional[tp.Dict[str, torch.Tensor]]:
+        key = (digest, name)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        if self.root is None:
+            return None
+        path = self._path(digest, name)
+        try:
+            value = torch.load(path, map_location='cpu')
+        except (FileNotFoundError, EOFError, RuntimeError):
+            return None
+        # the modification time orders the files for eviction
+        os.utime(path)
+        self._remember(key, value)
+        return value
+
+    def put(self, digest: str, name: str, value: tp.Dict[str, torch.Tensor]):
+        value = {k: v.detach().cpu() for k, v in value.items()}
+        self._remember((digest, name), value)
+        if self.root is None:
+            return
+        path = self._path(digest, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save(value, tmp_path)
+        os.replace(tmp_path, path)
+        self._evict_disk()
+
+    def _remember(self, key: tp.Tuple[str, str], value: tp.Dict[str, torch.Tensor]):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_entries:
+                self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        with self.lock:
+            files = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and entry.name.endswith('.pt'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,148 @@
+import typing as tp
+
+import torch
+
+
+class RepetitionWindow:
+    """Sliding window over the last `window` sampled tokens of every row and codebook, with a
+    persistent count of every token in it, so that the repetition penalty is a single vectorized
+    op per step instead of a stack/unique/bincount over the window for every row and codebook.
+
+    The tokens entering the window are added to the counts and, once it is full, the ones leaving
+    it are removed, from a ring buffer of the last `window` steps.
+
+    Args:
+        batch_size (int): Number of rows.
+        code_depth (int): Number of codebooks.
+        card (int): Number of distinct token values, including the special ones.
+        window (int): Number of recent steps penalized.
+        device (torch.device or str): Device of the counts.
+    """
+    def __init__(self, batch_size: int, code_depth: int, card: int, window: int,
+                 device: tp.Union[torch.device, str] = 'cpu'):
+        self.window = window
+        self.counts = torch.zeros((batch_size, code_depth, card), dtype=torch.int32, device=device)
+        self.ring = torch.zeros((batch_size, code_depth, max(window, 1)), dtype=torch.long, device=device)
+        self.ones = torch.ones((batch_size, code_depth, 1), dtype=torch.int32, device=device)
+        self.num_steps = 0
+
+    def push(self, tokens: torch.Tensor):
+        """Add the tokens of shape [B, K] sampled at this step."""
+        if self.window <= 0:
+            return
+        tokens = tokens.unsqueeze(-1)
+        slot = self.num_steps % self.window
+        if self.num_steps >= self.window:
+            self.counts.scatter_add_(-1, self.ring[..., slot:slot + 1], -self.ones)
+        self.counts.scatter_add_(-1, tokens, self.ones)
+        self.ring[..., slot:slot + 1] = tokens
+        self.num_steps += 1
+
+    def penalize(self, logits: torch.Tensor, penalty: float = 1.1, num_tokens: tp.Optional[int] = None):
+        """Divide in place by `penalty` the logits [B, K, card] of the tokens present in the window,
+        only considering the first `num_tokens` token values (e.g. to leave EOS alone)."""
+        if self.num_steps == 0:
+            return logits
+        num_tokens = logits.shape[-1] if num_tokens is None else num_tokens
+        present = self.counts[..., :num_tokens] > 0
+        logits[..., :num_tokens] = torch.where(present, logits[..., :num_tokens] / penalty, logits[..., :num_tokens])
+        return logits
+
+
+Generators = tp.Union[torch.Generator, tp.Sequence[torch.Generator], None]
+
+
+def gumbel_argmax(logits: torch.Tensor, generator: Generators = None) -> torch.Tensor:
+    """Sample from softmax(logits) along the last dimension with the Gumbel-max trick: one noise
+    draw and an argmax, no normalization and no `torch.multinomial`. Returns indices [..., 1].
+    With a list of generators, the rows (first dimension) are split into as many consecutive groups,
+    each one drawn from its own generator, so that a group does not depend on the other rows."""
+    if isinstance(generator, (list, tuple)):
+        assert logits.shape[0] % len(generator) == 0, f"{logits.shape[0]} rows for {len(generator)} generators"
+        noise = torch.cat([torch.empty_like(group, dtype=torch.float32).exponential_(generator=g)
+                           for group, g in zip(logits.chunk(len(generator)), generator)])
+    else:
+        noise = torch.empty_like(logits, dtype=torch.float32).exponential_(generator=generator)
+    # a zero draw would turn a masked (-inf) logit into nan
+    noise.clamp_min_(torch.finfo(torch.float32).tiny)
+    return torch.argmax(logits.float() - noise.log(), dim=-1, keepdim=True)
+
+
+class CodebookSampler:
+    """Sampling of the next token of every codebook in one batched pass, each codebook having its
+    own strategy:
+
+    - 'argmax': the most likely token (what top-k sampling with k=1 amounts to);
+    - 'top_k': Gumbel-max sampling among the `top_k` most likely tokens;
+    - 'top_p': Gumbel-max sampling among the smallest set of tokens of probability above `top_p`;
+    - 'multinomial': Gumbel-max sampling among all the tokens.
+
+    Codebooks sharing a strategy are sampled together. Random draws come from `generator` when
+    given, e.g. for reproducible benchmarks, else from the global RNG. A list of generators gives
+    every group of consecutive rows (e.g. the takes of a song) its own RNG, see `gumbel_argmax`.
+
+    Args:
+        strategies (list of str): Strategy of every codebook.
+        temp (float): Sampling temperature.
+        top_k (int): K of the 'top_k' codebooks.
+        top_p (float): P of the 'top_p' codebooks.
+        generator (torch.Generator or list of torch.Generator, optional): RNG of the random draws.
+    """
+    STRATEGIES = ['argmax', 'top_k', 'top_p', 'multinomial']
+
+    def __init__(self, strategies: tp.List[str], temp: float = 1.0, top_k: int = 0, top_p: float = 0.0,
+                 generator: Generators = None):
+        assert all(strategy in self.STRATEGIES for strategy in strategies), f"unknown strategy in {strategies}"
+        self.strategies = strategies
+        self.temp = temp
+        self.top_k = top_k
+        self.top_p = top_p
+        self.generator = generator
+        self.groups = {strategy: [q for q, s in enumerate(strategies) if s == strategy]
+                       for strategy in self.STRATEGIES if strategy in strategies}
+
+    @classmethod
+    def from_params(cls, code_depth: int, use_sampling: bool = True, temp: float = 1.0, top_k: int = 0,
+                    top_p: float = 0.0, generator: Generators = None) -> "CodebookSampler":
+        """Strategies of the LM generation parameters: top-p on every codebook, else top-k on the first
+        codebook and argmax on the others, else multinomial; argmax everywhere without sampling."""
+        if not use_sampling or temp <= 0.0:
+            strategies = ['argmax'] * code_depth
+        elif top_p > 0.0:
+            strategies = ['top_p'] * code_depth
+        elif top_k > 0:
+            strategies = ['top_k'] + ['argmax'] * (code_depth - 1)
+        else:
+            strategies = ['multinomial'] * code_depth
+        return cls(strategies, temp=temp, top_k=top_k, top_p=top_p, generator=generator)
+
+    def __call__(self, logits: torch.Tensor) -> torch.Tensor:
+        """Next tokens [B, K, 1] from the logits [B, K, card]."""
+        if len(self.groups) == 1:
+            # a single strategy, no gather/scatter of the codebooks
+            return self._sample(next(iter(self.groups)), logits)
+        next_token = torch.empty(logits.shape[:-1] + (1,), dtype=torch.long, device=logits.device)
+        for strategy, codebooks in self.groups.items():
+            if len(codebooks) == codebooks[-1] - codebooks[0] + 1:
+                # contiguous codebooks are a view
+                next_token[:, codebooks[0]:codebooks[-1] + 1] = \
+                    self._sample(strategy, logits[:, codebooks[0]:codebooks[-1] + 1])
+            else:
+                next_token[:, codebooks] = self._sample(strategy, logits[:, codebooks])
+        return next_token
+
+    def _sample(self, strategy: str, logits: torch.Tensor) -> torch.Tensor:
+        if strategy == 'argmax':
+            return torch.argmax(logits, dim=-1, keepdim=True)
+        logits = logits / self.temp
+        if strategy == 'top_k':
+            values, indices = torch.topk(logits, min(self.top_k, logits.shape[-1]), dim=-1)
+            return torch.gather(indices, -1, gumbel_argmax(values, self.generator))
+        if strategy == 'top_p':
+            sorted_logits, indices = torch.sort(logits, dim=-1, descending=True)
+            probs = torch.softmax(sorted_logits.float(), dim=-1)
+            # drop the tokens once the probability of the more likely ones exceeds p, the first is always kept
+            drop = torch.cumsum(probs, dim=-1) - probs > self.top_p
+            sorted_logits = sorted_logits.masked_fill(drop, float('-inf'))
+            return torch.gather(indices, -1, gumbel_argmax(sorted_logits, self.generator))
+        return gumbel_argmax(logits, self.generator)
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+import typing as tp
+
+import numpy as np
+import torch
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """sha256 of the content of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def checkpoint_id(ckpt_path: str) -> str:
+    """Cheap identity of a checkpoint file (path, size and modification time), hashing
+    several GB of weights on every run would cost more than what the store saves."""
+    stat = os.stat(ckpt_path)
+    return f"{os.path.abspath(ckpt_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class TokenStore:
+    """On-disk store of the LM tokens of generated songs, so that the audio can be rendered
+    (again) without sampling the LM.
+
+    Every entry is saved as its own npy shard `root/tokens/<key>.npy`, and described by a line of
+    the append-only index `root/index.jsonl`. Entries are keyed by `key(...)`, a hash of everything
+    the sampled tokens depend on.
+
+    Args:
+        root (str): Folder of the store, created if needed.
+        checkpoint (str): Identity of the LM checkpoint, see `checkpoint_id`.
+    """
+    def __init__(self, root: str, checkpoint: str = ""):
+        self.root = root
+        self.checkpoint = checkpoint
+        self.index_path = os.path.join(root, 'index.jsonl')
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'tokens'), exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted run
+                        continue
+                    self.index[entry['key']] = entry
+
+    def key(self, lyric: str, descriptions: tp.Optional[str], prompt: str,
+            generation_params: dict, seed: tp.Optional[int]) -> str:
+        """Hash of the lyric, descriptions, prompt identity, sampling params, seed and checkpoint."""
+        fields = {
+            'lyric': lyric,
+            'descriptions': descriptions,
+            'prompt': prompt,
+            'generation_params': generation_params,
+            'seed': seed,
+            'checkpoint': self.checkpoint,
+        }
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _shard_path(self, key: str) -> str:
+        return os.path.join(self.root, 'tokens', f"{key}.npy")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index and os.path.exists(self._shard_path(key))
+
+    def get(self, key: str) -> tp.Optional[torch.Tensor]:
+        """Tokens of shape [1, K, T] saved under `key`, or None."""
+        if key not in self:
+            return None
+        return torch.from_numpy(np.load(self._shard_path(key)).astype(np.int64))
+
+    def put(self, key: str, tokens: torch.Tensor, meta: tp.Optional[dict] = None):
+        """Save `tokens` of shape [1, K, T] under `key`, `meta` is kept in the index."""
+        codes = tokens.detach().cpu().numpy()
+        assert codes.min() >= 0 and codes.max() < 2 ** 15, "tokens do not fit in int16"
+        path = self._shard_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, codes.astype(np.int16))
+        os.replace(tmp_path, path)
+        entry = {'key': key, 'shape': list(codes.shape), 'meta': meta or {}}
+        with self.lock:
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.index[key] = entry
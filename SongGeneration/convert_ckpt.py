@@ -0,0 +1,38 @@
+"""
+One-time conversion of a checkpoint folder's `model.pt` into `model.safetensors`.
+When it exists, the generate scripts build the LM on the meta device and read its weights
+memory-mapped from this file, straight to the GPU, instead of initializing a CPU model and
+unpickling the whole checkpoint.
+
+    python3 convert_ckpt.py ckpt_path
+"""
+import sys
+import os
+
+import torch
+from safetensors.torch import save_file
+
+
+def convert_checkpoint(pt_path, out_path):
+    checkpoint = torch.load(pt_path, map_location='cpu', mmap=True)
+    state = {}
+    storages = set()
+    for key, tensor in checkpoint.items():
+        if not isinstance(tensor, torch.Tensor):
+            continue
+        tensor = tensor.contiguous()
+        # safetensors does not store tensors sharing memory
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr in storages:
+            tensor = tensor.clone()
+        storages.add(ptr)
+        state[key] = tensor
+    tmp_path = out_path + '.tmp'
+    save_file(state, tmp_path)
+    os.replace(tmp_path, out_path)
+    print(f"converted {len(state)} tensors from {pt_path} to {out_path}")
+
+
+if __name__ == "__main__":
+    ckpt_path = sys.argv[1]
+    convert_checkpoint(os.path.join(ckpt_path, 'model.pt'), os.path.join(ckpt_path, 'model.safetensors'))
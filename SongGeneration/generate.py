@@ -3,6 +3,9 @@ import os
 
 import time
 import json
+import argparse
+import threading
+import contextlib
 import torch
 import torchaudio
 import numpy as np
@@ -10,6 +13,11 @@ from omegaconf import OmegaConf
 
 from codeclm.trainer.codec_song_pl import CodecLM_PL
 from codeclm.models import CodecLM
+from codeclm.utils.pipeline import Pipeline, Stage
+from codeclm.utils.token_store import TokenStore, checkpoint_id, file_digest
+from codeclm.utils.prompt_cache import PromptAudioCache
+from codeclm.utils.prompt_bank import load_prompt_bank
+from codeclm.utils.journal import GenerationJournal, save_audio, write_manifest
 from third_party.demucs.models.pretrained import get_model_from_yaml
 
 auto_prompt_type = ['Pop', 'R&B', 'Dance', 'Jazz', 'Folk', 'Rock', 'Chinese Style', 'Chinese Tradition', 'Metal', 'Reggae', 'Chinese Opera', 'Auto']
@@ -21,6 +29,8 @@ class Separator:
         else:
             self.device = torch.device("cpu")
         self.demucs_model = self.init_demucs_model(dm_model_path, dm_config_path)
+        # the stems of a track are written to and removed from a shared folder, one run at a time
+        self.lock = threading.Lock()
 
     def init_demucs_model(self, model_path, config_path):
         model = get_model_from_yaml(config_path, model_path)
@@ -39,6 +49,10 @@ class Separator:
         return a[:, 0:48000*10]
     
     def run(self, audio_path, output_dir='tmp', ext=".flac"):
+        with self.lock:
+            return self._run(audio_path, output_dir, ext)
+
+    def _run(self, audio_path, output_dir, ext):
         os.makedirs(output_dir, exist_ok=True)
         name, _ = os.path.splitext(os.path.split(audio_path)[-1])
         output_paths = []
@@ -60,36 +74,47 @@ class Separator:
 
 
 
-if __name__ == "__main__":
-    torch.backends.cudnn.enabled = False
+def register_resolvers():
     OmegaConf.register_new_resolver("eval", lambda x: eval(x))
     OmegaConf.register_new_resolver("concat", lambda *x: [xxx for xx in x for xxx in xx])
     OmegaConf.register_new_resolver("get_fname", lambda: os.path.splitext(os.path.basename(sys.argv[1]))[0])
     OmegaConf.register_new_resolver("load_yaml", lambda x: list(OmegaConf.load(x)))
-    np.random.seed(int(time.time()))    
-    ckpt_path = sys.argv[1]
-    input_jsonl = sys.argv[2]
-    save_dir = sys.argv[3]
+
+
+def checkpoint_file(ckpt_path):
+    """Weights of a checkpoint folder: `model.safetensors` (see convert_ckpt.py) when present, else `model.pt`."""
+    safetensors_path = os.path.join(ckpt_path, 'model.safetensors')
+    if os.path.exists(safetensors_path):
+        return safetensors_path
+    return os.path.join(ckpt_path, 'model.pt')
+
+
+def build_model(ckpt_path, duration=None, extend_stride=None):
+    """Load the config and the full CodecLM (LM + both tokenizers) from a checkpoint folder,
+    on the GPU when there is one, else on the CPU. Songs last `duration` seconds (the trained
+    `max_dur` by default), longer ones are generated by windows advancing by `extend_stride`."""
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
     cfg_path = os.path.join(ckpt_path, 'config.yaml')
-    ckpt_path = os.path.join(ckpt_path, 'model.pt')
+    ckpt_path = checkpoint_file(ckpt_path)
     cfg = OmegaConf.load(cfg_path)
     cfg.mode = 'inference'
+    if device == 'cpu':
+        cfg.lm.use_flash_attn_2 = False
+        cfg.lm.attention_implementation = 'sdpa'
     max_duration = cfg.max_dur
     
     # Define model or load pretrained model
-    model_light = CodecLM_PL(cfg, ckpt_path)
+    model_light = CodecLM_PL(cfg, ckpt_path, lm_device=device)
 
-    model_light = model_light.eval().cuda()
+    model_light = model_light.eval().to(device)
     model_light.audiolm.cfg = cfg
+    model_light.audiolm.fuse_projections()
     model = CodecLM(name = "tmp",
         lm = model_light.audiolm,
         audiotokenizer = model_light.audio_tokenizer,
         max_duration = max_duration,
         seperate_tokenizer = model_light.seperate_tokenizer,
     )
-    separator = Separator()
-    auto_prompt = torch.load('ckpt/prompt.pt')
-    merge_prompt = [item for sublist in auto_prompt.values() for item in sublist]
     cfg_coef = 1.5 #25
     temp = 0.9
     top_k = 50
@@ -97,70 +122,408 @@ if __name__ == "__main__":
     record_tokens = True
     record_window = 50
 
-    model.set_generation_params(duration=max_duration, extend_stride=5, temperature=temp, cfg_coef=cfg_coef,
+    duration = max_duration if duration is None else duration
+    extend_stride = max_duration / 2 if extend_stride is None else extend_stride
+    model.set_generation_params(duration=duration, extend_stride=extend_stride, temperature=temp, cfg_coef=cfg_coef,
                                 top_k=top_k, top_p=top_p, record_tokens=record_tokens, record_window=record_window)
-    os.makedirs(save_dir, exist_ok=True)
-    os.makedirs(save_dir + "/audios", exist_ok=True)
-    os.makedirs(save_dir + "/jsonl", exist_ok=True)
+    return cfg, model
 
-    with open(input_jsonl, "r") as fp:
-        lines = fp.readlines()
 
-    new_items = []
-    for line in lines:
-        item = json.loads(line)
-        target_wav_name = f"{save_dir}/audios/{item['idx']}.flac"
-        lyric = item["gt_lyric"]
-        descriptions = item["descriptions"] if "descriptions" in item else None
-        # get prompt audio
-        if "prompt_audio_path" in item:
-            assert os.path.exists(item['prompt_audio_path']), f"prompt_audio_path {item['prompt_audio_path']} not found"
-            assert 'auto_prompt_audio_type' not in item, f"auto_prompt_audio_type and prompt_audio_path cannot be used together"
-            pmt_wav, vocal_wav, bgm_wav = separator.run(item['prompt_audio_path'])
-            melody_is_wav = True
-        elif "auto_prompt_audio_type" in item:
-            assert item["auto_prompt_audio_type"] in auto_prompt_type, f"auto_prompt_audio_type {item['auto_prompt_audio_type']} not found"
-            if item["auto_prompt_audio_type"] == "Auto": 
-                prompt_token = merge_prompt[np.random.randint(0, len(merge_prompt))]
+def lm_autocast(model):
+    """fp16 autocast of the LM on the GPU, nothing on the CPU."""
+    if model.device.type == 'cuda':
+        return torch.autocast(device_type="cuda", dtype=torch.float16)
+    return contextlib.nullcontext()
+
+
+def assign_seeds(items, seed=None):
+    """Give every item without a `seed` one, derived from `seed` or drawn at random, so that its
+    prompt choice and its LM sampling can be reproduced."""
+    for i, item in enumerate(items):
+        if 'seed' not in item:
+            item['seed'] = seed + i if seed is not None else int(np.random.randint(0, 2**31 - 1))
+    return items
+
+
+def token_generation_params(model):
+    """Generation parameters of `model` the LM tokens depend on, part of their token store key."""
+    generation_params = dict(model.generation_params, duration=model.duration)
+    if model.duration > model.max_duration:
+        generation_params['extend_stride'] = model.extend_stride
+    return generation_params
+
+
+def prompt_identity(item):
+    """String identifying the prompt of an item (once `prepare_prompt` ran on it)."""
+    if "prompt_audio_path" in item:
+        digest = item.get('prompt_audio_digest') or file_digest(item['prompt_audio_path'])
+        return f"audio:{digest}"
+    elif "auto_prompt_audio_type" in item:
+        return f"auto:{item['auto_prompt_audio_type']}:{item['auto_prompt_index']}"
+    return "none"
+
+
+_prompt_locks = {}
+_prompt_locks_guard = threading.Lock()
+
+
+def prompt_lock(digest):
+    """Lock of the reference track `digest`, held while it misses the prompt cache so that
+    concurrent prepare workers separate and encode the same track only once."""
+    with _prompt_locks_guard:
+        return _prompt_locks.setdefault(digest, threading.Lock())
+
+
+def separate_prompt(audio_path, separator, prompt_cache=None, digest=None):
+    """Separate a reference track into its (full, vocal, bgm) 10 s waveforms, reusing the
+    ones of `prompt_cache` when the same audio (of sha256 `digest`) was separated before."""
+    if prompt_cache is None:
+        return separator.run(audio_path)
+    digest = digest or file_digest(audio_path)
+    wavs = prompt_cache.get(digest, 'wavs')
+    if wavs is None:
+        with prompt_lock(digest):
+            wavs = prompt_cache.get(digest, 'wavs')
+            if wavs is None:
+                pmt_wav, vocal_wav, bgm_wav = separator.run(audio_path)
+                wavs = {'full': pmt_wav, 'vocal': vocal_wav, 'bgm': bgm_wav}
+                prompt_cache.put(digest, 'wavs', wavs)
+    return wavs['full'], wavs['vocal'], wavs['bgm']
+
+
+def encode_prompt_codes(model, prompt, digest, prompt_cache=None):
+    """(melody, vocal, bgm) codes of the separated reference track `prompt` of sha256 `digest`,
+    taken from `prompt_cache` when the same audio was encoded before. Only the tokenizers of
+    `model` are used."""
+    pmt_wav, vocal_wav, bgm_wav, _ = prompt
+    if prompt_cache is None:
+        return model.encode_prompt_audio(pmt_wav, vocal_wav, bgm_wav)
+    codes = prompt_cache.get(digest, 'codes')
+    if codes is None:
+        with prompt_lock(digest):
+            codes = prompt_cache.get(digest, 'codes')
+            if codes is None:
+                melody_tokens, vocal_tokens, bgm_tokens = model.encode_prompt_audio(pmt_wav, vocal_wav, bgm_wav)
+                codes = {'melody': melody_tokens, 'vocal': vocal_tokens, 'bgm': bgm_tokens}
+                prompt_cache.put(digest, 'codes', codes)
+    return codes['melody'].to(model.device), codes['vocal'].to(model.device), codes['bgm'].to(model.device)
+
+
+def encode_prompt(model, item, prompt, prompt_cache=None):
+    """Prompt tokens [1, 3, T] of an item, the codes of a reference track are taken from
+    `prompt_cache` when the same audio was encoded before."""
+    pmt_wav, vocal_wav, bgm_wav, melody_is_wav = prompt
+    if prompt_cache is None or "prompt_audio_path" not in item:
+        return model.prepare_prompt_tokens(melody_wavs=pmt_wav, vocal_wavs=vocal_wav, 
+                                           bgm_wavs=bgm_wav, melody_is_wav=melody_is_wav)
+    melody_tokens, vocal_tokens, bgm_tokens = encode_prompt_codes(model, prompt, item['prompt_audio_digest'],
+                                                                  prompt_cache)
+    return model.prepare_prompt_tokens(melody_wavs=melody_tokens, vocal_wavs=vocal_tokens,
+                                       bgm_wavs=bgm_tokens, melody_is_wav=False)
+
+
+def prepare_prompt(item, separator, prompt_bank, prompt_cache=None):
+    """Resolve the prompt of a JSONL item into (pmt_wav, vocal_wav, bgm_wav, melody_is_wav).
+    The auto prompt picked is recorded in `item['auto_prompt_index']`, the sha256 of a reference
+    track in `item['prompt_audio_digest']` (hashed once, for the caches and the token key).
+    """
+    if "prompt_audio_path" in item:
+        assert os.path.exists(item['prompt_audio_path']), f"prompt_audio_path {item['prompt_audio_path']} not found"
+        assert 'auto_prompt_audio_type' not in item, f"auto_prompt_audio_type and prompt_audio_path cannot be used together"
+        item['prompt_audio_digest'] = file_digest(item['prompt_audio_path'])
+        pmt_wav, vocal_wav, bgm_wav = separate_prompt(item['prompt_audio_path'], separator, prompt_cache,
+                                                      item['prompt_audio_digest'])
+        melody_is_wav = True
+    elif "auto_prompt_audio_type" in item:
+        assert item["auto_prompt_audio_type"] in auto_prompt_type, f"auto_prompt_audio_type {item['auto_prompt_audio_type']} not found"
+        if "auto_prompt_index" not in item:
+            rng = np.random.RandomState(item['seed']) if 'seed' in item else np.random
+            item["auto_prompt_index"], _ = prompt_bank.sample(item["auto_prompt_audio_type"], rng)
+        # the bank keeps int16 views, the LM takes long tokens
+        prompt_token = prompt_bank.get(item["auto_prompt_audio_type"], item["auto_prompt_index"]).long()
+        pmt_wav = prompt_token[:,[0],:]
+        vocal_wav = prompt_token[:,[1],:]
+        bgm_wav = prompt_token[:,[2],:]
+        melody_is_wav = False
+    else:
+        pmt_wav = None
+        vocal_wav = None
+        bgm_wav = None
+        melody_is_wav = True
+    return pmt_wav, vocal_wav, bgm_wav, melody_is_wav
+
+
+def prepare_batch(model, items, separator, prompt_bank, encode=True, prompt_cache=None):
+    """First stage: separate/encode the prompts of a batch of JSONL items. Without `encode`,
+    only the raw prompts needed by the diffusion are prepared."""
+    prompts = [prepare_prompt(item, separator, prompt_bank, prompt_cache) for item in items]
+    if not encode:
+        return {'items': items, 'prompts': prompts, 'audio_qt_embs': None}
+    with lm_autocast(model):
+        audio_qt_embs = torch.cat([encode_prompt(model, item, prompt, prompt_cache) 
+                                   for item, prompt in zip(items, prompts)], dim=0)
+    return {'items': items, 'prompts': prompts, 'audio_qt_embs': audio_qt_embs}
+
+
+def output_indices(item, num_variations=1):
+    """idx of the output songs of an input item, `<idx>_<v>` for every take when there are several."""
+    if num_variations == 1:
+        return [f"{item['idx']}"]
+    return [f"{item['idx']}_{v}" for v in range(num_variations)]
+
+
+def expand_variations(batch, num_variations, token_keys=None):
+    """Replace every input item of a batch with one output item per take, sharing its prompt."""
+    if num_variations == 1:
+        return batch
+    items = []
+    for i, item in enumerate(batch['items']):
+        for v, idx in enumerate(output_indices(item, num_variations)):
+            take = dict(item, idx=idx, variation=v)
+            if token_keys is not None:
+                take["token_key"] = token_keys[i][v]
+            items.append(take)
+    batch['items'] = items
+    batch['prompts'] = [prompt for prompt in batch['prompts'] for _ in range(num_variations)]
+    return batch
+
+
+def sample_batch_tokens(model, batch, token_store=None, generate_missing=True, num_variations=1):
+    """Second stage: sample the LM tokens of all the songs of a batch together.
+    With a `token_store`, songs already in the store are not sampled again and the new ones are saved.
+    With `num_variations`, every song is sampled that many times from one prefill of its conditions,
+    and the batch then holds one output item per take (see `expand_variations`).
+    """
+    items = batch['items']
+    lyrics = [item["gt_lyric"].replace("  ", " ") for item in items]
+    descriptions = [item["descriptions"] if "descriptions" in item else None for item in items]
+    tokens = [[None] * num_variations for _ in items]
+    token_keys = None
+    if token_store is not None:
+        generation_params = token_generation_params(model)
+        token_keys = []
+        for i, item in enumerate(items):
+            if num_variations == 1:
+                if "token_key" not in item:
+                    item["token_key"] = token_store.key(lyrics[i], descriptions[i], prompt_identity(item), 
+                                                        generation_params, item.get('seed'))
+                token_keys.append([item["token_key"]])
             else:
-                prompt_token = auto_prompt[item["auto_prompt_audio_type"]][np.random.randint(0, len(auto_prompt[item["auto_prompt_audio_type"]]))]
-            pmt_wav = prompt_token[:,[0],:]
-            vocal_wav = prompt_token[:,[1],:]
-            bgm_wav = prompt_token[:,[2],:]
-            melody_is_wav = False
-        else:
-            pmt_wav = None
-            vocal_wav = None
-            bgm_wav = None
-            melody_is_wav = True
-            
-        generate_inp = {
-            'lyrics': [lyric.replace("  ", " ")],
-            'descriptions': [descriptions],
-            'melody_wavs': pmt_wav,
-            'vocal_wavs': vocal_wav,
-            'bgm_wavs': bgm_wav,
-            'melody_is_wav': melody_is_wav,
-        }
+                # the takes depend on how many of them are sampled together
+                token_keys.append([token_store.key(lyrics[i], descriptions[i], prompt_identity(item), 
+                                                   dict(generation_params, num_variations=num_variations, variation=v),
+                                                   item.get('seed')) for v in range(num_variations)])
+            for v, key in enumerate(token_keys[i]):
+                stored = token_store.get(key)
+                tokens[i][v] = stored.to(model.device) if stored is not None else None
+    # the takes of a song are sampled together, a song is sampled again as soon as one of them is missing
+    missing = [i for i, song_tokens in enumerate(tokens) if any(t is None for t in song_tokens)]
+    if missing and not generate_missing:
+        raise KeyError(f"tokens of {[items[i]['idx'] for i in missing]} are not in the token store")
+
+    start_time = time.time()
+    if missing:
+        # every song draws from its own seeded generator, its tokens do not depend on the rest of the batch
+        generators = None
+        if all('seed' in items[i] for i in missing):
+            generators = [torch.Generator(device=model.device).manual_seed(items[i]['seed']) for i in missing]
+        with lm_autocast(model):
+            new_tokens = model.generate([lyrics[i] for i in missing], [descriptions[i] for i in missing], 
+                                        audio_qt_embs=batch['audio_qt_embs'][missing], return_tokens=True,
+                                        num_variations=num_variations, generators=generators)
+        if len(missing) * num_variations == 1:
+            new_tokens = [new_tokens]
+        for j, i in enumerate(missing):
+            for v in range(num_variations):
+                t = new_tokens[j * num_variations + v]
+                tokens[i][v] = t
+                if token_store is not None:
+                    token_store.put(token_keys[i][v], t, 
+                                    meta={'idx': output_indices(items[i], num_variations)[v], 'seed': items[i].get('seed')})
+    batch['tokens'] = [t for song_tokens in tokens for t in song_tokens]
+    batch['lm_cost'] = time.time() - start_time
+    return expand_variations(batch, num_variations, token_keys)
+
+
+def decode_batch(model, batch, save_dir, sample_rate, journal=None, diffusion_batch=1):
+    """Third stage: diffuse and save the songs of a batch, `diffusion_batch` songs at a time (their
+    diffusion windows batched together), return the output items.
+    Every song is added to the `journal` as soon as its audio is saved."""
+    items = batch['items']
+    songs = list(zip(items, batch['prompts'], batch['tokens']))
+    for i in range(0, len(songs), diffusion_batch):
+        group = songs[i:i+diffusion_batch]
         start_time = time.time()
-        with torch.autocast(device_type="cuda", dtype=torch.float16):
-            tokens = model.generate(**generate_inp, return_tokens=True)
-        mid_time = time.time()
-            
         with torch.no_grad():
-            if melody_is_wav:   
-                wav_seperate = model.generate_audio(tokens, pmt_wav, vocal_wav, bgm_wav)
+            if len(group) == 1:
+                item, (pmt_wav, vocal_wav, bgm_wav, melody_is_wav), song_tokens = group[0]
+                if melody_is_wav:   
+                    wavs = [model.generate_audio(song_tokens, pmt_wav, vocal_wav, bgm_wav)]
+                else:
+                    wavs = [model.generate_audio(song_tokens)]
             else:
-                wav_seperate = model.generate_audio(tokens)
+                prompts = [(vocal_wav, bgm_wav) if melody_is_wav else (None, None)
+                           for _, (pmt_wav, vocal_wav, bgm_wav, melody_is_wav), _ in group]
+                wavs = model.generate_audio_batch([song_tokens for _, _, song_tokens in group],
+                                                  [vocal_wav for vocal_wav, _ in prompts], [bgm_wav for _, bgm_wav in prompts])
         end_time = time.time()
-        torchaudio.save(target_wav_name, wav_seperate[0].cpu().float(), cfg.sample_rate)
-        print(f"process{item['idx']}, lm cost {mid_time - start_time}s, diffusion cost {end_time - mid_time}")
+        for (item, _, _), wav_seperate in zip(group, wavs):
+            target_wav_name = f"{save_dir}/audios/{item['idx']}.flac"
+            sha256 = save_audio(target_wav_name, wav_seperate[0].cpu().float(), sample_rate)
+            print(f"process{item['idx']}, lm cost {batch['lm_cost']}s (batch of {len(items)}), "
+                  f"diffusion cost {end_time - start_time} (batch of {len(group)})")
 
-        item["idx"] = f"{item['idx']}"
-        item["wav_path"] = target_wav_name
-        new_items.append(item)
-    
+            item["idx"] = f"{item['idx']}"
+            item["wav_path"] = target_wav_name
+            if journal is not None:
+                journal.record(item, sha256)
+    return items
+
+
+def generate_songs(model, items, separator, prompt_bank, save_dir, sample_rate,
+                   token_store=None, stage='all', prompt_cache=None, journal=None, num_variations=1,
+                   diffusion_batch=1):
+    """Generate the songs of several JSONL items into `save_dir/audios` and return the output items.
+    The LM tokens of all the items are sampled as one batch, the audio is then decoded `diffusion_batch`
+    songs at a time.
+    `stage` 'tokens' only fills the token store, 'audio' only renders tokens found in the store.
+    With `num_variations`, every item gives that many takes, saved as `<idx>_<v>`.
+    """
+    batch = prepare_batch(model, items, separator, prompt_bank, encode=stage != 'audio', 
+                          prompt_cache=prompt_cache)
+    batch = sample_batch_tokens(model, batch, token_store, generate_missing=stage != 'audio', 
+                                num_variations=num_variations)
+    if stage == 'tokens':
+        return batch['items']
+    return decode_batch(model, batch, save_dir, sample_rate, journal, diffusion_batch)
+
+
+def generate_songs_pipelined(model, items, separator, prompt_bank, save_dir, sample_rate,
+                             batch_size=1, prepare_workers=1, diffusion_workers=1, queue_size=1,
+                             token_store=None, stage='all', prompt_cache=None, journal=None, num_variations=1,
+                             diffusion_batch=1):
+    """Same as calling `generate_songs` on every batch of `items`, but the prompt preparation,
+    the LM sampling and the diffusion of consecutive batches overlap. The LM stage always has a
+    single worker as its streaming state is shared. Prepare workers share the separator, which
+    runs one track at a time. Every diffusion worker decodes its own batch on the shared weights,
+    so `diffusion_workers` workers need that many times the activation memory of one diffusion.
+    """
+    stages = [
+        Stage('prepare', lambda batch: prepare_batch(model, batch, separator, prompt_bank, 
+                                                     encode=stage != 'audio', prompt_cache=prompt_cache), prepare_workers),
+        Stage('tokens', lambda batch: sample_batch_tokens(model, batch, token_store, 
+                                                          generate_missing=stage != 'audio', 
+                                                          num_variations=num_variations), 1),
+    ]
+    if stage == 'tokens':
+        stages.append(Stage('done', lambda batch: batch['items'], 1))
+    else:
+        stages.append(Stage('diffusion', lambda batch: decode_batch(model, batch, save_dir, sample_rate, journal, 
+                                                                            diffusion_batch), diffusion_workers))
+    pipeline = Pipeline(stages, queue_size=queue_size)
+    batches = [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+    return [item for batch in pipeline.run(batches) for item in batch]
+
+
+def generate_song(model, item, separator, prompt_bank, save_dir, sample_rate, prompt_cache=None):
+    """Generate the song of one JSONL item into `save_dir/audios` and return the output item."""
+    return generate_songs(model, [item], separator, prompt_bank, save_dir, sample_rate, 
+                          prompt_cache=prompt_cache)[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ckpt_path')
+    parser.add_argument('input_jsonl')
+    parser.add_argument('save_dir')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="number of songs whose LM tokens are sampled together")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="overlap prompt preparation, LM sampling and diffusion of consecutive batches (uses more GPU memory)")
+    parser.add_argument('--prepare_workers', type=int, default=1,
+                        help="threads separating/encoding prompts (demucs itself runs one track at a time)")
+    parser.add_argument('--diffusion_workers', type=int, default=1,
+                        help="threads decoding batches concurrently, each one with its own diffusion activations "
+                             "(N workers need about N times the diffusion memory)")
+    parser.add_argument('--queue_size', type=int, default=1,
+                        help="number of batches waiting between two pipeline stages")
+    parser.add_argument('--token_store', default=None,
+                        help="folder where the LM tokens are saved and looked up before sampling")
+    parser.add_argument('--stage', default='all', choices=['all', 'tokens', 'audio'],
+                        help="'tokens' only samples the LM tokens, 'audio' only renders tokens of the token store")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="base seed of the items without a `seed` field (random by default)")
+    parser.add_argument('--prompt_cache', default=None,
+                        help="folder caching the separated waveforms and codes of the reference tracks")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the songs a previous run into the same save_dir already finished")
+    parser.add_argument('--duration', type=float, default=None,
+                        help="duration of the songs in seconds, beyond the max_dur of the checkpoint they are generated by windows")
+    parser.add_argument('--extend_stride', type=float, default=None,
+                        help="seconds added by every window after the first one (default: half of max_dur)")
+    parser.add_argument('--num_variations', type=int, default=1,
+                        help="number of takes of every song, sampled from a single prefill of its conditions")
+    parser.add_argument('--diffusion_steps', type=int, default=50,
+                        help="number of ODE steps of every diffusion window")
+    parser.add_argument('--solver', default='euler', choices=['euler', 'midpoint', 'heun', 'dpm_multistep', 'rk23'],
+                        help="ODE solver of the diffusion (midpoint/heun take 2 estimator passes per step, rk23 adapts its steps)")
+    parser.add_argument('--guidance_interval', type=float, nargs=2, default=None, metavar=('T_MIN', 'T_MAX'),
+                        help="apply the diffusion classifier free guidance only for t in [T_MIN, T_MAX] (t=1 is the audio)")
+    parser.add_argument('--uncond_reuse', type=int, default=0,
+                        help="number of diffusion steps reusing the last unconditional estimate of the guidance")
+    parser.add_argument('--diffusion_batch', type=int, default=1,
+                        help="number of songs of a batch whose diffusion windows are decoded together")
+    args = parser.parse_args()
+
+    torch.backends.cudnn.enabled = False
+    register_resolvers()
+    np.random.seed(int(time.time()))    
+    ckpt_path = args.ckpt_path
+    input_jsonl = args.input_jsonl
+    save_dir = args.save_dir
+    assert args.stage == 'all' or args.token_store is not None, f"--stage {args.stage} needs a --token_store"
+    cfg, model = build_model(ckpt_path, duration=args.duration, extend_stride=args.extend_stride)
+    model.set_decode_params(num_steps=args.diffusion_steps, solver=args.solver,
+                            guidance_interval=args.guidance_interval, uncond_reuse=args.uncond_reuse)
+    token_store = None
+    if args.token_store is not None:
+        token_store = TokenStore(args.token_store, checkpoint=checkpoint_id(checkpoint_file(ckpt_path)))
+    separator = Separator()
+    prompt_bank = load_prompt_bank()
+    prompt_cache = PromptAudioCache(args.prompt_cache) if args.prompt_cache is not None else None
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(save_dir + "/audios", exist_ok=True)
+    os.makedirs(save_dir + "/jsonl", exist_ok=True)
+
+    with open(input_jsonl, "r") as fp:
+        lines = fp.readlines()
+
+    items = assign_seeds([json.loads(line) for line in lines], args.seed)
     src_jsonl_name = os.path.split(input_jsonl)[-1]
-    with open(f"{save_dir}/jsonl/{src_jsonl_name}.jsonl", "w", encoding='utf-8') as fw:
-        for item in new_items:
-            fw.writelines(json.dumps(item, ensure_ascii=False)+"\n")
+    journal = None
+    if args.stage != 'tokens':
+        journal = GenerationJournal(f"{save_dir}/jsonl/{src_jsonl_name}.journal", resume=args.resume)
+        todo = [item for item in items 
+                if not all(journal.is_done(idx) for idx in output_indices(item, args.num_variations))]
+        print(f"{len(items) - len(todo)} / {len(items)} songs already done")
+    else:
+        todo = items
+    if args.pipeline:
+        new_items = generate_songs_pipelined(model, todo, separator, prompt_bank, save_dir, cfg.sample_rate,
+                                             batch_size=args.batch_size, prepare_workers=args.prepare_workers,
+                                             diffusion_workers=args.diffusion_workers, queue_size=args.queue_size,
+                                             token_store=token_store, stage=args.stage, prompt_cache=prompt_cache,
+                                             journal=journal, num_variations=args.num_variations,
+                                             diffusion_batch=args.diffusion_batch)
+    else:
+        new_items = []
+        for i in range(0, len(todo), args.batch_size):
+            new_items += generate_songs(model, todo[i:i+args.batch_size], separator, prompt_bank, 
+                                        save_dir, cfg.sample_rate, token_store=token_store, stage=args.stage, 
+                                        prompt_cache=prompt_cache, journal=journal, 
+                                        num_variations=args.num_variations, diffusion_batch=args.diffusion_batch)
+    
+    if journal is not None:
+        # the songs of the previous runs are taken from the journal, in input order
+        new_items = journal.items(idx for item in items for idx in output_indices(item, args.num_variations))
+    write_manifest(f"{save_dir}/jsonl/{src_jsonl_name}.jsonl", new_items)
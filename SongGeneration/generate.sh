@@ -7,4 +7,5 @@ export PYTHONPATH="$(pwd)/codeclm/tokenizer/":"$(pwd)":"$(pwd)/codeclm/tokenizer
 CKPT_PATH=$1
 JSONL=$2
 SAVE_DIR=$3
-python3 generate.py $CKPT_PATH $JSONL $SAVE_DIR
+shift 3
+python3 generate.py $CKPT_PATH $JSONL $SAVE_DIR "$@"
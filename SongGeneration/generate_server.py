@@ -0,0 +1,174 @@
+"""
+Long-lived generation worker.
+
+Loads CodecLM (LM + both tokenizers), the demucs separator and the auto-prompt bank once
+(and caches the separation/codes of the reference tracks across jobs) and serves JSONL generation jobs over localhost HTTP, so that every song does not pay the
+model load again:
+
+    POST /jobs          {"items": [<jsonl entry>, ...], "save_dir": "...", "name": "..."}
+                        -> {"job_id": "...", "position": 0}
+    GET  /jobs/<job_id> -> {"status": "queued" | "running" | "done" | "failed", "position": ...,
+                            "done": 2, "total": 4, "items": [...], "error": null}
+    GET  /health        -> {"status": "ok", "queued": 0}
+"""
+import sys
+import os
+
+import time
+import json
+import uuid
+import queue
+import argparse
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+import numpy as np
+
+from generate import Separator, register_resolvers, build_model, generate_song
+from codeclm.utils.prompt_cache import PromptAudioCache
+from codeclm.utils.journal import write_manifest
+from codeclm.utils.prompt_bank import load_prompt_bank
+
+
+class GenerationWorker:
+    """Keeps the models resident and runs the submitted jobs one after the other."""
+    def __init__(self, ckpt_path, prompt_cache_dir=None):
+        self.cfg, self.model = build_model(ckpt_path)
+        self.separator = Separator()
+        self.prompt_bank = load_prompt_bank()
+        self.prompt_cache = PromptAudioCache(prompt_cache_dir)
+        self.jobs = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, items, save_dir, name=None):
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id,
+            'status': 'queued',
+            'save_dir': save_dir,
+            'name': name or f"{job_id}.jsonl",
+            'total': len(items),
+            'done': 0,
+            'items': [],
+            'error': None,
+            'submit_time': time.time(),
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self.pending.append(job_id)
+            position = len(self.pending) - 1
+        self.queue.put((job_id, items))
+        return job_id, position
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job, items=list(job['items']))
+            job['position'] = self.pending.index(job_id) if job_id in self.pending else 0
+        return job
+
+    def _loop(self):
+        while True:
+            job_id, items = self.queue.get()
+            with self.lock:
+                job = self.jobs[job_id]
+                job['status'] = 'running'
+            try:
+                self._run(job, items)
+                with self.lock:
+                    job['status'] = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    job['status'] = 'failed'
+                    job['error'] = str(e)
+            finally:
+                with self.lock:
+                    self.pending.remove(job_id)
+                torch.cuda.empty_cache()
+
+    def _run(self, job, items):
+        save_dir = job['save_dir']
+        os.makedirs(save_dir + "/audios", exist_ok=True)
+        os.makedirs(save_dir + "/jsonl", exist_ok=True)
+        try:
+            for item in items:
+                item = generate_song(self.model, item, self.separator, self.prompt_bank,
+                                     save_dir, self.cfg.sample_rate, prompt_cache=self.prompt_cache)
+                with self.lock:
+                    job['items'].append(item)
+                    job['done'] += 1
+        finally:
+            # the songs finished before a failing item are still listed
+            with self.lock:
+                done_items = list(job['items'])
+            write_manifest(f"{save_dir}/jsonl/{job['name']}.jsonl", done_items)
+
+
+def make_handler(worker):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok', 'queued': worker.queue.qsize()})
+            elif self.path.startswith('/jobs/'):
+                job = worker.status(self.path[len('/jobs/'):])
+                if job is None:
+                    self._send(404, {'error': 'unknown job'})
+                else:
+                    self._send(200, job)
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                items = body['items']
+                save_dir = body['save_dir']
+            except (ValueError, KeyError) as e:
+                self._send(400, {'error': f"bad request: {e}"})
+                return
+            job_id, position = worker.submit(items, save_dir, body.get('name'))
+            self._send(200, {'job_id': job_id, 'position': position})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ckpt_path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--prompt_cache', default=None,
+                        help="folder also keeping the reference track cache on disk (memory only by default)")
+    args = parser.parse_args()
+
+    torch.backends.cudnn.enabled = False
+    register_resolvers()
+    np.random.seed(int(time.time()))
+    worker = GenerationWorker(args.ckpt_path, args.prompt_cache)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(worker))
+    print(f"generation worker listening on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,173 @@
+"""
+Offline launcher sharding a JSONL across several worker processes, each one running the
+generate.py pipeline on its own device:
+
+    python3 generate_sharded.py ckpt_path lyrics.jsonl output_path --devices cuda:0,cuda:1 --workers 4
+    python3 generate_sharded.py ckpt_path lyrics.jsonl output_path --devices cpu --workers 2 --cpu_threads 8
+
+Items are not split ahead of time: the workers take batches one at a time from a shared queue,
+longest lyrics first, so a worker which is done early picks up the remaining work instead of
+waiting for a straggler. Worker `rank` writes into `output_path/shards/<rank>/{audios,jsonl}`,
+and once all of them are done the audios are moved to `output_path/audios` and the items merged,
+in input order, into `output_path/jsonl/<input name>.jsonl`.
+"""
+import sys
+import os
+
+import json
+import time
+import shutil
+import argparse
+import traceback
+import multiprocessing as mp
+
+
+def worker_main(rank, device, cpu_threads, args, task_queue, prompt_bank_root):
+    # must happen before CUDA is initialized in this process: the assigned GPU becomes 'cuda'
+    if device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = device.split(':')[-1] if ':' in device else '0'
+    import torch
+    import numpy as np
+    if cpu_threads is not None:
+        torch.set_num_threads(cpu_threads)
+    from generate import (Separator, register_resolvers, build_model, checkpoint_file, generate_songs)
+    from codeclm.utils.prompt_bank import PromptBank
+    from codeclm.utils.prompt_cache import PromptAudioCache
+    from codeclm.utils.token_store import TokenStore, checkpoint_id
+
+    torch.backends.cudnn.enabled = False
+    register_resolvers()
+    np.random.seed(int(time.time()) + rank)
+    shard_dir = os.path.join(args.save_dir, 'shards', str(rank))
+    os.makedirs(shard_dir + "/audios", exist_ok=True)
+    os.makedirs(shard_dir + "/jsonl", exist_ok=True)
+
+    cfg, model = build_model(args.ckpt_path)
+    separator = Separator()
+    prompt_bank = PromptBank(prompt_bank_root)
+    prompt_cache = PromptAudioCache(args.prompt_cache) if args.prompt_cache is not None else None
+    token_store = None
+    if args.token_store is not None:
+        token_store = TokenStore(args.token_store, checkpoint=checkpoint_id(checkpoint_file(args.ckpt_path)))
+    print(f"worker {rank} ready on {device}")
+
+    with open(f"{shard_dir}/jsonl/items.jsonl", "a", encoding='utf-8') as fw:
+        while True:
+            batch = task_queue.get()
+            if batch is None:
+                break
+            try:
+                items = generate_songs(model, batch, separator, prompt_bank, shard_dir, cfg.sample_rate,
+                                       token_store=token_store, prompt_cache=prompt_cache)
+            except Exception:
+                traceback.print_exc()
+                print(f"worker {rank} failed on {[item['idx'] for item in batch]}")
+                continue
+            for item in items:
+                fw.write(json.dumps(item, ensure_ascii=False) + "\n")
+            fw.flush()
+
+
+def merge_shards(items, save_dir, name):
+    """Move the audios of every shard to `save_dir/audios` and write the items in input order."""
+    done = {}
+    shards_dir = os.path.join(save_dir, 'shards')
+    for rank in sorted(os.listdir(shards_dir), key=int):
+        path = os.path.join(shards_dir, rank, 'jsonl', 'items.jsonl')
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                item = json.loads(line)
+                done[f"{item['idx']}"] = item
+
+    os.makedirs(save_dir + "/audios", exist_ok=True)
+    os.makedirs(save_dir + "/jsonl", exist_ok=True)
+    merged, missing = [], []
+    for item in items:
+        idx = f"{item['idx']}"
+        if idx not in done:
+            missing.append(idx)
+            continue
+        out = done[idx]
+        target_wav_name = f"{save_dir}/audios/{idx}.flac"
+        if os.path.exists(out['wav_path']) and os.path.abspath(out['wav_path']) != os.path.abspath(target_wav_name):
+            shutil.move(out['wav_path'], target_wav_name)
+        out['wav_path'] = target_wav_name
+        merged.append(out)
+    with open(f"{save_dir}/jsonl/{name}.jsonl", "w", encoding='utf-8') as fw:
+        for item in merged:
+            fw.writelines(json.dumps(item, ensure_ascii=False)+"\n")
+    return merged, missing
+
+
+def default_devices():
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    except ImportError:
+        pass
+    return ['cpu']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ckpt_path')
+    parser.add_argument('input_jsonl')
+    parser.add_argument('save_dir')
+    parser.add_argument('--devices', default=None,
+                        help="comma separated devices given round-robin to the workers, e.g. cuda:0,cuda:1 or cpu "
+                             "(default: every visible GPU, else cpu)")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: one per device)")
+    parser.add_argument('--cpu_threads', type=int, default=None, help="torch threads of every CPU worker")
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="number of songs whose LM tokens are sampled together")
+    parser.add_argument('--token_store', default=None)
+    parser.add_argument('--prompt_cache', default=None)
+    parser.add_argument('--seed', type=int, default=None,
+                        help="base seed of the items without a `seed` field (random by default)")
+    args = parser.parse_args()
+
+    devices = args.devices.split(',') if args.devices else default_devices()
+    num_workers = args.workers or len(devices)
+
+    with open(args.input_jsonl, "r") as fp:
+        items = [json.loads(line) for line in fp if line.strip()]
+    # seeds are fixed here so that the result does not depend on which worker runs an item
+    from generate import assign_seeds
+    assign_seeds(items, args.seed)
+    # packed once here, the workers only map it
+    from codeclm.utils.prompt_bank import load_prompt_bank
+    prompt_bank_root = load_prompt_bank().root
+
+    # longest songs first, batched with songs of similar length
+    ordered = sorted(items, key=lambda item: len(item["gt_lyric"]), reverse=True)
+    batches = [ordered[i:i+args.batch_size] for i in range(0, len(ordered), args.batch_size)]
+
+    shutil.rmtree(os.path.join(args.save_dir, 'shards'), ignore_errors=True)
+    ctx = mp.get_context('spawn')
+    task_queue = ctx.Queue()
+    for batch in batches:
+        task_queue.put(batch)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+    processes = []
+    for rank in range(num_workers):
+        device = devices[rank % len(devices)]
+        cpu_threads = args.cpu_threads if device == 'cpu' else None
+        process = ctx.Process(target=worker_main, args=(rank, device, cpu_threads, args, task_queue, prompt_bank_root))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+    src_jsonl_name = os.path.split(args.input_jsonl)[-1]
+    merged, missing = merge_shards(items, args.save_dir, src_jsonl_name)
+    print(f"{len(merged)} / {len(items)} songs generated")
+    if missing:
+        print(f"not generated: {missing}")
+        sys.exit(1)
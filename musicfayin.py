@@ -18,6 +18,8 @@ import re
 import glob
 
 import threading
+import heapq
+import itertools
 
 # 在文件顶部添加项目根目录定义
 PROJECT_ROOT = Path(__file__).parent  # 假设musicfayin.py现在放在SongGeneration的父目录
@@ -33,6 +35,17 @@ def get_absolute_path(relative_path: str) -> Path:
 # 常量定义
 DEEPSEEK_API_KEY = st.secrets['DEEPSEEK_API_KEY'] # 换成你自己的API KEY
 DEEPSEEK_URL = st.secrets['DEEPSEEK_URL']
+# 常驻生成服务地址 (SongGeneration/generate_server.sh)，不可用时回退为每次启动生成脚本
+GENERATION_WORKER_URL = os.getenv("MUSICFAYIN_WORKER_URL", "http://127.0.0.1:8765")
+# 等待常驻生成服务完成一个任务的最长时间 (秒)
+GENERATION_WORKER_TIMEOUT = float(os.getenv("MUSICFAYIN_WORKER_TIMEOUT", 2 * 3600))
+# 各生成模式的峰值显存估计 (GB)，调度器据此判断空闲显存是否足够启动任务
+GENERATION_PEAK_MEMORY_GB = {
+    "generate.sh": 28.0,
+    "generate_lowmem.sh": 12.0,
+}
+# 参考音频的分离结果和编码缓存（按音频内容哈希），重复使用同一参考音频时跳过分离和编码
+PROMPT_CACHE_DIR = get_absolute_path("cache/prompt_audio")
 
 # “悲伤的”、“情绪的”、“愤怒的”、“快乐的”、“令人振奋的”、“强烈的”、“浪漫的”、“忧郁的”
 EMOTIONS = [
@@ -740,8 +753,139 @@ def save_jsonl(entries: List[Dict], filename: str) -> str:
     
     return str(filepath)
 
-def run_music_generation(jsonl_path: str, output_dir: str = "output"):
+def worker_available() -> bool:
+    """检查常驻生成服务 (generate_server.py) 是否在运行"""
+    try:
+        response = requests.get(f"{GENERATION_WORKER_URL}/health", timeout=2)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def run_music_generation_on_worker(jsonl_path: str, output_dir: str = "output") -> bool:
+    """将JSONL任务提交给常驻生成服务并轮询结果（模型只需加载一次）
+
+    任务提交失败时返回False，由调用方回退为启动生成脚本；提交成功后返回True。
+    """
+    with open(get_absolute_path(jsonl_path), "r", encoding="utf-8") as f:
+        items = [json.loads(line) for line in f if line.strip()]
+
+    try:
+        response = requests.post(
+            f"{GENERATION_WORKER_URL}/jobs",
+            json={
+                "items": items,
+                "save_dir": str(get_absolute_path(output_dir)),
+                "name": os.path.split(jsonl_path)[-1],
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+    except requests.RequestException as e:
+        st.warning(f"⚠️ 提交到常驻生成服务失败，改为启动生成脚本: {e}")
+        return False
+
+    status_text = st.empty()
+    progress_bar = st.progress(0)
+    deadline = time.time() + GENERATION_WORKER_TIMEOUT
+    try:
+        while True:
+            # 任务已提交，服务断开或超时时不再回退，以免同一任务生成两次
+            if time.time() > deadline:
+                st.error(f"❌ 等待生成服务超时 ({GENERATION_WORKER_TIMEOUT:.0f}秒)，任务 {job_id} 可能仍在运行")
+                return True
+            job = requests.get(f"{GENERATION_WORKER_URL}/jobs/{job_id}", timeout=10).json()
+            if job["status"] == "queued":
+                status_text.text(f"排队中，前面还有 {job['position']} 个任务...")
+            elif job["status"] == "running":
+                status_text.text(f"音乐生成中 ({job['done']}/{job['total']})...")
+                progress_bar.progress(job["done"] / max(job["total"], 1))
+            else:
+                break
+            time.sleep(2)
+    except requests.RequestException as e:
+        st.error(f"❌ 与生成服务的连接中断: {e}")
+        return True
+    finally:
+        status_text.empty()
+        progress_bar.empty()
+
+    if job["status"] == "done":
+        st.success("🎵 音乐生成完成！")
+        display_generated_files(get_absolute_path(output_dir))
+    else:
+        st.error(f"❌ 生成失败: {job['error']}")
+    return True
+
+
+class GenerationScheduler:
+    """进程内（所有Streamlit会话共享）的生成任务调度器
+
+    任务按 (优先级, 提交顺序) 排队，数值小的优先，同优先级先来先服务。
+    只有队首任务的峰值显存估计不超过当前可用显存时才放行：可用显存取
+    GPU实际空闲显存与 (总显存 - 已放行任务的预留显存) 中的较小值，
+    这样刚启动、还没加载完模型的任务也被计算在内。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = []  # 堆: (priority, seq, job_id)
+        self.seq = itertools.count()
+        self.waiting = {}  # 排队中的任务 -> (priority, seq, 峰值显存估计)
+        self.reserved = {}  # 运行中的任务 -> 预留显存 (GB)
+
+    def submit(self, peak_memory_gb: float, priority: int = 0) -> int:
+        with self.lock:
+            job_id = next(self.seq)
+            heapq.heappush(self.queue, (priority, job_id, job_id))
+            self.waiting[job_id] = (priority, job_id, peak_memory_gb)
+            return job_id
+
+    def position(self, job_id: int) -> int:
+        """前面还有多少个任务在排队"""
+        with self.lock:
+            key = self.waiting[job_id][:2]
+            return sum(1 for entry in self.queue if entry[:2] < key)
+
+    def try_admit(self, job_id: int) -> bool:
+        """队首任务的显存需求能满足时将其出队并预留显存"""
+        with self.lock:
+            if not self.queue or self.queue[0][2] != job_id:
+                return False
+            peak = self.waiting[job_id][2]
+            gpu_info = get_gpu_memory()
+            if gpu_info is not None:
+                available = min(gpu_info["free"], gpu_info["total"] - sum(self.reserved.values()))
+                # 估计值超过整卡显存时，只要没有其他任务在运行就放行，避免永远等待
+                if peak > available and (self.reserved or peak <= gpu_info["total"]):
+                    return False
+            heapq.heappop(self.queue)
+            del self.waiting[job_id]
+            self.reserved[job_id] = peak
+            return True
+
+    def release(self, job_id: int):
+        with self.lock:
+            self.reserved.pop(job_id, None)
+            if job_id in self.waiting:
+                # 未放行就被取消的任务（如会话中断）
+                del self.waiting[job_id]
+                self.queue = [entry for entry in self.queue if entry[2] != job_id]
+                heapq.heapify(self.queue)
+
+
+@st.cache_resource
+def get_generation_scheduler() -> GenerationScheduler:
+    return GenerationScheduler()
+
+
+def run_music_generation(jsonl_path: str, output_dir: str = "output", priority: int = 0):
     """执行音乐生成命令（日志直接输出到终端）"""
+    if worker_available():
+        st.info(f"使用常驻生成服务: {GENERATION_WORKER_URL}")
+        if run_music_generation_on_worker(jsonl_path, output_dir):
+            return
+
     # 获取显存信息
     gpu_info = get_gpu_memory()
     
@@ -751,8 +895,10 @@ def run_music_generation(jsonl_path: str, output_dir: str = "output"):
     if gpu_info and gpu_info["total"] >= 30:
         script = "generate.sh"
         st.info(f"检测到充足显存 ({gpu_info['total']:.1f}GB)，将使用标准生成模式")
+    elif gpu_info:
+        st.warning(f"显存不足30GB ({gpu_info['total']:.1f}GB)，使用低显存模式")
     else:
-        st.warning(f"显存不足30GB ({gpu_info['total']:.1f}GB if available)，使用低显存模式")
+        st.warning("未检测到GPU显存信息，使用低显存模式")
     
     # 使用绝对路径
     cmd = [
@@ -760,7 +906,8 @@ def run_music_generation(jsonl_path: str, output_dir: str = "output"):
         str(SONG_GEN_DIR / script),
         str(SONG_GEN_DIR / "ckpt/songgeneration_base/"),
         str(get_absolute_path(jsonl_path)),
-        str(get_absolute_path(output_dir))
+        str(get_absolute_path(output_dir)),
+        "--prompt_cache", str(PROMPT_CACHE_DIR)
     ]
     
     # 显示执行命令
@@ -768,19 +915,30 @@ def run_music_generation(jsonl_path: str, output_dir: str = "output"):
     
     # 显示状态信息
     status_text = st.empty()
-    status_text.text("音乐生成中，请查看终端输出...")
-    
-    # 执行命令 - 直接输出到终端
-    process = subprocess.Popen(
-        cmd,
-        cwd=str(SONG_GEN_DIR),
-        stdout=sys.stdout,  # 直接输出到终端
-        stderr=sys.stderr,  # 错误也输出到终端
-        universal_newlines=True
-    )
-    
-    # 等待命令完成
-    return_code = process.wait()
+
+    # 排队等待足够的空闲显存，避免多个会话同时加载模型导致OOM
+    scheduler = get_generation_scheduler()
+    job_id = scheduler.submit(GENERATION_PEAK_MEMORY_GB[script], priority)
+    try:
+        while not scheduler.try_admit(job_id):
+            status_text.text(f"排队中，前面还有 {scheduler.position(job_id)} 个任务，"
+                             f"等待约 {GENERATION_PEAK_MEMORY_GB[script]:.0f}GB 空闲显存...")
+            time.sleep(2)
+        status_text.text("音乐生成中，请查看终端输出...")
+        
+        # 执行命令 - 直接输出到终端
+        process = subprocess.Popen(
+            cmd,
+            cwd=str(SONG_GEN_DIR),
+            stdout=sys.stdout,  # 直接输出到终端
+            stderr=sys.stderr,  # 错误也输出到终端
+            universal_newlines=True
+        )
+        
+        # 等待命令完成
+        return_code = process.wait()
+    finally:
+        scheduler.release(job_id)
     status_text.empty()  # 清除状态信息
     
     # 检查是否有生成的音频文件
@@ -916,9 +1074,11 @@ def get_gpu_memory():
     try:
         if torch.cuda.is_available():
             device = torch.cuda.current_device()
-            total_memory = torch.cuda.get_device_properties(device).total_memory / (1024**3)  # 转换为GB
-            used_memory = torch.cuda.memory_allocated(device) / (1024**3)
-            free_memory = total_memory - used_memory
+            # mem_get_info 统计整张卡的占用（包括其他进程中的生成任务），memory_allocated 只统计本进程
+            free_memory, total_memory = torch.cuda.mem_get_info(device)
+            free_memory = free_memory / (1024**3)  # 转换为GB
+            total_memory = total_memory / (1024**3)
+            used_memory = total_memory - free_memory
             return {
                 "total": total_memory,
                 "used": used_memory,